@@ -1,26 +1,139 @@
 """
-Run `pip install srsly` to use this script
+Run `pip install ijson orjson zstandard` to use this script (and `pip install polars` for the
+faster, in-memory `--engine polars` option)
 
 This script converts the JSON data file from https://www.kaggle.com/datasets/zynicide/wine-reviews
-to a .gzip line-delimited (.jsonl) file for use downstream with the databases in question.
+to a .gzip (or .zst) line-delimited (.jsonl) file for use downstream with the databases in question.
 
 Full credit to the original author, @zynicide, on Kaggle, for the data.
 """
+import argparse
+import gzip
+import os
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from itertools import islice
 from pathlib import Path
-from typing import Any
+from typing import Any, Iterable, Iterator
 
-import srsly
+import ijson
+import orjson
+import zstandard as zstd
 
 JsonBlob = dict[str, Any]
 
+# Default compression level per output format: fast levels give nearly the same ratio on JSON text
+# at a fraction of the CPU cost, and zstd level 3 matches DEFLATE-6 ratio at a much higher speed
+DEFAULT_COMPRESSLEVEL = {"gz": 1, "zst": 3}
 
-def convert_to_jsonl(filename: str) -> None:
-    data = srsly.read_json(filename)
-    # Add an `id` field to the start of each dict item so we have a primary key for indexing
-    new_data = [{"id": idx, **item} for idx, item in enumerate(data, 1)]
-    srsly.write_gzip_jsonl(f"{Path(filename).stem}.jsonl.gz", new_data)
+
+def chunk_iterable(items: Iterable[JsonBlob], chunksize: int) -> Iterator[tuple[JsonBlob, ...]]:
+    """
+    Break a large iterable into an iterable of smaller iterables of size `chunksize`
+    """
+    iterator = iter(items)
+    while chunk := tuple(islice(iterator, chunksize)):
+        yield chunk
+
+
+def iter_data(filename: str) -> Iterator[JsonBlob]:
+    """Lazily yield items from the JSON array so that the full dataset is never held in memory"""
+    with open(filename, "rb") as f:
+        # `use_float` returns floats instead of Decimal objects, which orjson can't serialize
+        for idx, item in enumerate(ijson.items(f, "item", use_float=True), 1):
+            # Add an `id` field to the start of each dict item so we have a primary key for indexing
+            yield {"id": idx, **item}
+
+
+def iter_serialized_chunks(filename: str, chunksize: int) -> Iterator[bytes]:
+    """
+    Read the JSON array into a polars DataFrame and yield it as chunks of serialized JSONL.
+    The `id` column and the serialization are handled in Rust, at the cost of holding the full
+    dataset in memory.
+    """
+    import polars as pl
+
+    # Scan every row to infer the schema, as some columns are null for long runs of rows
+    df = pl.read_json(filename, infer_schema_length=None).with_row_index("id", offset=1)
+    for frame in df.iter_slices(chunksize):
+        yield frame.write_ndjson().encode()
+
+
+def compress_chunk(chunk: tuple[JsonBlob, ...] | bytes, fmt: str, compresslevel: int) -> bytes:
+    """Serialize a chunk to JSONL and compress it as a standalone gzip member or zstd frame"""
+    if isinstance(chunk, bytes):
+        # Already serialized to JSONL
+        data = chunk
+    else:
+        # orjson serializes to bytes directly, so no str -> bytes encoding is needed
+        data = b"\n".join(orjson.dumps(item) for item in chunk) + b"\n"
+    if fmt == "zst":
+        return zstd.ZstdCompressor(level=compresslevel).compress(data)
+    return gzip.compress(data, compresslevel=compresslevel)
+
+
+def write_chunked_data(
+    chunks: Iterable[tuple[JsonBlob, ...] | bytes],
+    output_name: str,
+    compresslevel: int = 1,
+    workers: int | None = None,
+) -> None:
+    """
+    Compress chunks in parallel across processes and write them out in submission order.
+    Concatenated gzip members (and zstd frames) decompress as a single stream, so the
+    output is a regular .jsonl.gz (or .jsonl.zst) file.
+    """
+    fmt = "zst" if output_name.endswith(".zst") else "gz"
+    workers = workers or os.cpu_count() or 1
+    with open(output_name, "wb") as f, ProcessPoolExecutor(max_workers=workers) as executor:
+        pending: deque[Future[bytes]] = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(compress_chunk, chunk, fmt, compresslevel))
+            # Bound the number of in-flight chunks so that memory use doesn't grow with the input
+            if len(pending) >= 2 * workers:
+                f.write(pending.popleft().result())
+        while pending:
+            f.write(pending.popleft().result())
+
+
+def convert_to_jsonl(
+    filename: str,
+    fmt: str = "gz",
+    compresslevel: int | None = None,
+    workers: int | None = None,
+    engine: str = "ijson",
+    chunksize: int = 5000,
+) -> None:
+    if compresslevel is None:
+        compresslevel = DEFAULT_COMPRESSLEVEL[fmt]
+    if engine == "polars":
+        chunks = iter_serialized_chunks(filename, chunksize)
+    else:
+        chunks = chunk_iterable(iter_data(filename), chunksize)
+    write_chunked_data(
+        chunks,
+        f"{Path(filename).stem}.jsonl.{fmt}",
+        compresslevel=compresslevel,
+        workers=workers,
+    )
 
 
 if __name__ == "__main__":
+    # fmt: off
+    parser = argparse.ArgumentParser("Convert the wine reviews JSON data to compressed JSONL")
+    parser.add_argument("--filename", type=str, default="winemag-data-130k-v2.json", help="Name of the JSON file to convert")
+    parser.add_argument("--format", type=str, default="gz", choices=["gz", "zst"], help="Compression format of the output file")
+    parser.add_argument("--compresslevel", type=int, default=None, help="Compression level (defaults to 1 for gz and 3 for zst)")
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes to compress chunks with (defaults to all cores)")
+    parser.add_argument("--engine", type=str, default="ijson", choices=["ijson", "polars"], help="Stream the JSON with ijson, or load and serialize it all at once with polars")
+    args = vars(parser.parse_args())
+    # fmt: on
+
     # Download the JSON data file from https://www.kaggle.com/datasets/zynicide/wine-reviews'
-    convert_to_jsonl("winemag-data-130k-v2.json")
+    convert_to_jsonl(
+        args["filename"],
+        fmt=args["format"],
+        compresslevel=args["compresslevel"],
+        workers=args["workers"],
+        engine=args["engine"],
+    )
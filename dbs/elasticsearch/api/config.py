@@ -1,9 +1,15 @@
+from dotenv import load_dotenv
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
+# Load the .env file into os.environ once, at import time, so that workers forked from a preloaded
+# app inherit it and `Settings()` only needs to read environment variables (existing variables,
+# such as those passed in via docker compose, take precedence)
+load_dotenv(override=False)
+
 
 class Settings(BaseSettings):
     model_config = SettingsConfigDict(
-        env_file=".env",
+        env_file=None,
         extra="allow",
     )
 
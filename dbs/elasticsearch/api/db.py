@@ -0,0 +1,54 @@
+from typing import Any
+
+import orjson
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.serializer import JSONSerializer, SerializationError
+
+# Long-lived client shared by all requests in this process, set up in the app's lifespan
+_client: AsyncElasticsearch | None = None
+
+
+class OrjsonSerializer(JSONSerializer):
+    """
+    Drop-in replacement for the client's stdlib json serializer, which is used for request and
+    response bodies as well as each action line in bulk requests
+    """
+
+    # The public methods are overridden, rather than the `json_dumps`/`json_loads` hooks, which
+    # older releases of elastic-transport don't call, so the parent's handling is kept here
+    def dumps(self, data: Any) -> bytes:
+        # Bodies that are already serialized are sent as they are
+        if isinstance(data, str):
+            return data.encode("utf-8", "surrogatepass")
+        if isinstance(data, bytes):
+            return data
+        try:
+            # Fall back to the parent's handling of types that orjson can't serialize natively
+            return orjson.dumps(data, default=self.default)
+        except (ValueError, UnicodeError, TypeError) as e:
+            raise SerializationError(
+                message=f"Unable to serialize to JSON: {data!r} (type: {type(data).__name__})",
+                errors=(e,),
+            )
+
+    def loads(self, data: bytes) -> Any:
+        # Some responses are typed as json but have an empty body
+        if data == b"":
+            return None
+        try:
+            return orjson.loads(data)
+        except (ValueError, TypeError) as e:
+            raise SerializationError(
+                message=f"Unable to deserialize as JSON: {data!r}", errors=(e,)
+            )
+
+
+def set_client(client: AsyncElasticsearch | None) -> None:
+    global _client
+    _client = client
+
+
+def get_client() -> AsyncElasticsearch:
+    if _client is None:
+        raise RuntimeError("Elasticsearch client is not initialized - is the app lifespan running?")
+    return _client
@@ -3,10 +3,13 @@ from collections.abc import AsyncGenerator
 from contextlib import asynccontextmanager
 from functools import lru_cache
 
+from elastic_transport import SecurityWarning
 from elasticsearch import AsyncElasticsearch
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 
 from api.config import Settings
+from api.db import OrjsonSerializer, set_client
 from api.routers import rest
 
 
@@ -24,8 +27,10 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     password = settings.elastic_password
     port = settings.elastic_port
     service = settings.elastic_service
+    # Only silence the TLS warning raised for `verify_certs=False`, and only while creating the
+    # client, so that warnings raised while serving requests are still surfaced
     with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
+        warnings.filterwarnings("ignore", category=SecurityWarning)
         elastic_client = AsyncElasticsearch(
             f"http://{service}:{port}",
             basic_auth=(username, password),
@@ -33,13 +38,17 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
             max_retries=3,
             retry_on_timeout=True,
             verify_certs=False,
+            # gzip request/response bodies, as wine documents are text-heavy and compress well
+            http_compress=True,
+            serializers={"application/json": OrjsonSerializer()},
         )
-        """Async context manager for Elasticsearch connection."""
-        app.client = elastic_client
-        print("Successfully connected to Elasticsearch")
-        yield
-        await elastic_client.close()
-        print("Successfully closed Elasticsearch connection")
+    # Keep one long-lived client per process instead of attaching it to the app instance
+    set_client(elastic_client)
+    print("Successfully connected to Elasticsearch")
+    yield
+    await elastic_client.close()
+    set_client(None)
+    print("Successfully closed Elasticsearch connection")
 
 
 app = FastAPI(
@@ -49,6 +58,8 @@ app = FastAPI(
     ),
     version=get_settings().tag,
     lifespan=lifespan,
+    # Serialize responses with orjson rather than the stdlib json encoder
+    default_response_class=ORJSONResponse,
 )
 
 
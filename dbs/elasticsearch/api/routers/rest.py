@@ -1,3 +1,6 @@
+from operator import itemgetter
+
+from api.db import get_client
 from api.schemas.rest import (
     CountByCountry,
     FullTextSearch,
@@ -5,10 +8,21 @@ from api.schemas.rest import (
     TopWinesByProvince,
 )
 from elasticsearch import AsyncElasticsearch
-from fastapi import APIRouter, HTTPException, Query, Request
+from fastapi import APIRouter, HTTPException, Query
 
 router = APIRouter()
 
+# Extract the document from each search hit
+_get_source = itemgetter("_source")
+# Only return the fields we read from ES responses, to cut payload size and client-side parsing
+# (note that ES then omits the `hits` envelope entirely when nothing matches)
+SEARCH_FILTER_PATH = ["hits.hits._source"]
+COUNT_FILTER_PATH = ["count"]
+# Static parts of the queries are built once at import time and shared across requests. They
+# must never be mutated: only the small per-request nodes that hold user input are built inline
+SORT_BY_POINTS = {"points": {"order": "desc"}}
+KEYWORD_SEARCH_FIELDS = ["title", "description", "variety"]
+
 
 # --- Routes ---
 
@@ -19,13 +33,12 @@ router = APIRouter()
     response_description="Search wines by title, description and variety",
 )
 async def search_by_keywords(
-    request: Request,
     terms: str = Query(description="Search wine by keywords in title, description and variety"),
     max_price: int = Query(
         default=100.0, description="Specify the maximum price for the wine (e.g., 30)"
     ),
 ) -> list[FullTextSearch] | None:
-    result = await _search_by_keywords(request.app.client, terms, max_price)
+    result = await _search_by_keywords(get_client(), terms, max_price)
     if not result:
         raise HTTPException(
             status_code=404,
@@ -40,12 +53,11 @@ async def search_by_keywords(
     response_description="Get top-rated wines by country",
 )
 async def top_by_country(
-    request: Request,
     country: str = Query(
         description="Get top-rated wines by country name specified (must be exact name)"
     ),
 ) -> list[TopWinesByCountry] | None:
-    result = await _top_by_country(request.app.client, country)
+    result = await _top_by_country(get_client(), country)
     if not result:
         raise HTTPException(
             status_code=404,
@@ -60,12 +72,11 @@ async def top_by_country(
     response_description="Get top-rated wines by province",
 )
 async def top_by_province(
-    request: Request,
     province: str = Query(
         description="Get top-rated wines by province name specified (must be exact name)"
     ),
 ) -> list[TopWinesByProvince] | None:
-    result = await _top_by_province(request.app.client, province)
+    result = await _top_by_province(get_client(), province)
     if not result:
         raise HTTPException(
             status_code=404,
@@ -80,10 +91,9 @@ async def top_by_province(
     response_description="Get counts of wine for a particular country",
 )
 async def count_by_country(
-    request: Request,
     country: str = Query(description="Country name to get counts for"),
 ) -> CountByCountry | None:
-    result = await _count_by_country(request.app.client, country)
+    result = await _count_by_country(get_client(), country)
     if not result:
         raise HTTPException(
             status_code=404,
@@ -98,12 +108,11 @@ async def count_by_country(
     response_description="Get counts of wine for a particular country, filtered by points and price",
 )
 async def count_by_filters(
-    request: Request,
     country: str = Query(description="Country name to get counts for"),
     points: int = Query(default=85, description="Minimum number of points for a wine"),
     price: float = Query(default=100.0, description="Maximum price for a wine"),
 ) -> CountByCountry | None:
-    result = await _count_by_filters(request.app.client, country, points, price)
+    result = await _count_by_filters(get_client(), country, points, price)
     if not result:
         raise HTTPException(
             status_code=404,
@@ -123,29 +132,21 @@ async def _search_by_keywords(
         size=5,
         query={
             "bool": {
-                "must": [
-                    {
-                        "multi_match": {
-                            "query": terms,
-                            "fields": ["title", "description", "variety"],
-                            "minimum_should_match": 2,
-                            "fuzziness": "AUTO",
-                        }
+                "must": {
+                    "multi_match": {
+                        "query": terms,
+                        "fields": KEYWORD_SEARCH_FIELDS,
+                        "minimum_should_match": 2,
+                        "fuzziness": "AUTO",
                     }
-                ],
+                },
                 "filter": {"range": {"price": {"lte": max_price}}},
             }
         },
-        sort={"points": {"order": "desc"}},
+        sort=SORT_BY_POINTS,
+        filter_path=SEARCH_FILTER_PATH,
     )
-    result = response["hits"].get("hits")
-    if result:
-        data = []
-        for item in result:
-            data_dict = item["_source"]
-            data.append(data_dict)
-        return data
-    return None
+    return list(map(_get_source, response.get("hits", {}).get("hits", []))) or None
 
 
 async def _top_by_country(
@@ -154,27 +155,12 @@ async def _top_by_country(
     response = await client.search(
         index="wines",
         size=5,
-        query={
-            "bool": {
-                "must": [
-                    {
-                        "match_phrase": {
-                            "country": country,
-                        }
-                    }
-                ]
-            }
-        },
-        sort={"points": {"order": "desc"}},
+        # Exact-name lookup as an unscored filter on the keyword (`.raw`) subfield from the mapping
+        query={"bool": {"filter": {"term": {"country.raw": country}}}},
+        sort=SORT_BY_POINTS,
+        filter_path=SEARCH_FILTER_PATH,
     )
-    result = response["hits"].get("hits")
-    if result:
-        data = []
-        for item in result:
-            data_dict = item["_source"]
-            data.append(data_dict)
-        return data
-    return None
+    return list(map(_get_source, response.get("hits", {}).get("hits", []))) or None
 
 
 async def _top_by_province(
@@ -183,32 +169,18 @@ async def _top_by_province(
     response = await client.search(
         index="wines",
         size=5,
-        query={
-            "bool": {
-                "must": [
-                    {
-                        "match_phrase": {
-                            "province": province,
-                        }
-                    }
-                ]
-            }
-        },
-        sort={"points": {"order": "desc"}},
+        query={"bool": {"filter": {"term": {"province.raw": province}}}},
+        sort=SORT_BY_POINTS,
+        filter_path=SEARCH_FILTER_PATH,
     )
-    result = response["hits"].get("hits")
-    if result:
-        data = []
-        for item in result:
-            data_dict = item["_source"]
-            data.append(data_dict)
-        return data
-    return None
+    return list(map(_get_source, response.get("hits", {}).get("hits", []))) or None
 
 
 async def _count_by_country(client: AsyncElasticsearch, country: str) -> CountByCountry | None:
     response = await client.count(
-        index="wines", query={"bool": {"must": [{"match": {"country": country}}]}}
+        index="wines",
+        query={"match": {"country": country}},
+        filter_path=COUNT_FILTER_PATH,
     )
     result = {"count": response.get("count", 0)}
     return result
@@ -228,6 +200,7 @@ async def _count_by_filters(
                 ]
             }
         },
+        filter_path=COUNT_FILTER_PATH,
     )
     result = {"count": response.get("count", 0)}
     return result
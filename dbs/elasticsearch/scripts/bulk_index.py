@@ -1,24 +1,45 @@
 import argparse
 import asyncio
+import io
 import os
 import sys
 import warnings
+from asyncio import Future
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from functools import lru_cache, partial
+from itertools import islice
 from pathlib import Path
-from typing import Any, Iterator
+from typing import Any, Iterable, Iterator
 
-import srsly
+import msgspec
+import orjson
+import rapidgzip
+import uvloop
+import zstandard as zstd
 from dotenv import load_dotenv
-from elasticsearch import AsyncElasticsearch, helpers
-from schemas.wine import Wine
+from elastic_transport import SecurityWarning
+from elasticsearch import AsyncElasticsearch, ElasticsearchWarning, helpers
+from schemas.wine import WineStruct
 
 sys.path.insert(1, os.path.realpath(Path(__file__).resolve().parents[1]))
 from api.config import Settings
+from api.db import OrjsonSerializer
 
 load_dotenv()
 # Custom types
 JsonBlob = dict[str, Any]
 
+decode_wines = msgspec.json.Decoder(WineStruct, strict=False).decode_lines
+encode_json = msgspec.json.Encoder().encode
+# Index settings that are swapped in for the duration of the bulk load
+BULK_LOAD_SETTINGS: JsonBlob = {
+    "index.refresh_interval": "-1",
+    "index.number_of_replicas": 0,
+    "index.translog.durability": "async",
+    "index.translog.flush_threshold_size": "1gb",
+}
+
 
 class FileNotFoundError(Exception):
     pass
@@ -33,37 +54,70 @@ def get_settings():
     return Settings()
 
 
-def chunk_iterable(item_list: list[JsonBlob], chunksize: int) -> Iterator[tuple[JsonBlob, ...]]:
+def chunk_iterable(items: Iterable[bytes], chunksize: int) -> Iterator[tuple[bytes, ...]]:
     """
     Break a large iterable into an iterable of smaller iterables of size `chunksize`
     """
-    for i in range(0, len(item_list), chunksize):
-        yield tuple(item_list[i : i + chunksize])
+    iterator = iter(items)
+    while chunk := tuple(islice(iterator, chunksize)):
+        yield chunk
+
+
+def read_gzip_jsonl(file_path: Path) -> Iterator[bytes]:
+    """Stream raw lines of json from a gzipped (.jsonl.gz) file"""
+    # rapidgzip inflates the file across all cores, unlike the single-threaded stdlib gzip module
+    with rapidgzip.open(str(file_path), parallelization=os.cpu_count()) as fh:
+        for line in io.BufferedReader(fh):
+            if line := line.strip():
+                yield line
+
 
+def read_zstd_jsonl(file_path: Path) -> Iterator[bytes]:
+    """Stream raw lines of json from a zstandard-compressed (.jsonl.zst) file"""
+    # The file may hold several zstd frames (one per chunk written by data/convert.py)
+    with open(file_path, "rb") as fh, zstd.ZstdDecompressor().stream_reader(
+        fh, read_across_frames=True
+    ) as reader:
+        for line in io.BufferedReader(reader):
+            if line := line.strip():
+                yield line
 
-def get_json_data(data_dir: Path, filename: str) -> list[JsonBlob]:
-    """Get all line-delimited json files (.jsonl) from a directory with a given prefix"""
+
+def get_json_data(data_dir: Path, filename: str) -> Iterator[bytes]:
+    """
+    Lazily read lines from a compressed line-delimited json file (.jsonl.gz or .jsonl.zst).
+    Lines are left unparsed, so that they can be cheaply passed to worker processes to validate.
+    """
     file_path = data_dir / filename
     if not file_path.is_file():
-        # File may not have been uncompressed yet so try to do that first
-        data = srsly.read_gzip_jsonl(file_path)
-        # This time if it isn't there it really doesn't exist
-        if not file_path.is_file():
-            raise FileNotFoundError(f"No valid .jsonl file found in `{data_dir}`")
-    else:
-        data = srsly.read_gzip_jsonl(file_path)
-    return data
+        raise FileNotFoundError(f"No valid .jsonl file found in `{data_dir}`")
+    read_jsonl = read_zstd_jsonl if file_path.suffix == ".zst" else read_gzip_jsonl
+    return read_jsonl(file_path)
 
 
 def validate(
-    data: tuple[JsonBlob],
+    data: bytes,
     exclude_none: bool = False,
 ) -> list[JsonBlob]:
-    validated_data = [Wine(**item).model_dump(exclude_none=exclude_none) for item in data]
-    return validated_data
-
-
-def process_chunks(data: list[JsonBlob]) -> tuple[list[JsonBlob], str]:
+    """Validate a chunk of json lines and turn them into bulk index actions"""
+    # Parse and validate the whole batch in one call to msgspec's C decoder (`strict=False` allows
+    # the same str -> int/float coercions as pydantic), then convert the structs to plain dicts
+    wines = decode_wines(data)
+    fields = WineStruct.__struct_fields__
+    actions = []
+    for wine in wines:
+        if exclude_none:
+            # Read only the non-null fields off the struct, instead of filtering a full `asdict` copy
+            doc = {f: v for f in fields if (v := getattr(wine, f)) is not None}
+        else:
+            doc = msgspec.structs.asdict(wine)
+        # Serialize each document up front, as the bulk helpers send a `bytes` source as-is
+        # rather than re-encoding it on the event loop with the stdlib json module
+        actions.append({"_id": wine.id, "_source": encode_json(doc)})
+    return actions
+
+
+def process_chunks(data: bytes) -> list[JsonBlob]:
     validated_data = validate(data, exclude_none=True)
     return validated_data
 
@@ -78,73 +132,175 @@ async def get_elastic_client(settings) -> AsyncElasticsearch:
     PORT = settings.elastic_port
     ELASTIC_URL = settings.elastic_url
     # Connect to ElasticSearch
-    elastic_client = AsyncElasticsearch(
-        f"http://{ELASTIC_URL}:{PORT}",
-        basic_auth=(USERNAME, PASSWORD),
-        request_timeout=300,
-        max_retries=3,
-        retry_on_timeout=True,
-        verify_certs=False,
-    )
+    with warnings.catch_warnings():
+        warnings.filterwarnings("ignore", category=SecurityWarning)
+        elastic_client = AsyncElasticsearch(
+            f"http://{ELASTIC_URL}:{PORT}",
+            basic_auth=(USERNAME, PASSWORD),
+            request_timeout=300,
+            max_retries=3,
+            retry_on_timeout=True,
+            verify_certs=False,
+            # Bulk request bodies are large, repetitive JSON, so gzip them before sending
+            http_compress=True,
+            serializers={"application/json": OrjsonSerializer()},
+        )
     return elastic_client
 
 
 async def create_index(client: AsyncElasticsearch, index: str, mappings_path: Path) -> None:
     """Create an index associated with an alias in ElasticSearch"""
-    elastic_config = dict(srsly.read_json(mappings_path))
+    if await client.indices.exists_alias(name=index):
+        print(f"Found index {index} in db, skipping index creation...\n")
+        return
+    print(f"Did not find index {index} in db, creating index...\n")
+    elastic_config = orjson.loads(mappings_path.read_bytes())
     assert elastic_config is not None
+    with warnings.catch_warnings():
+        # Ignore deprecation notices sent back by the server for the index settings
+        warnings.filterwarnings("ignore", category=ElasticsearchWarning)
+        #  Get settings and mappings from the mappings.json file
+        mappings = elastic_config.get("mappings")
+        settings = elastic_config.get("settings")
+        index_name = f"{index}-1"
+        try:
+            # Create the index and its alias atomically, in a single round trip
+            await client.indices.create(
+                index=index_name, mappings=mappings, settings=settings, aliases={index: {}}
+            )
+            print(f"Created index {index_name} with alias {index}\n")
+        except Exception as e:
+            print(f"Warning: Did not create index {index_name} due to exception {e}\n")
+
+
+async def prepare_index_for_bulk_load(client: AsyncElasticsearch, index: str) -> JsonBlob:
+    """
+    Turn off refreshes and replication while the index is loaded, as nothing searches it yet, and
+    return the settings that this replaces
+    """
+    response = await client.indices.get_settings(
+        index=index, name=list(BULK_LOAD_SETTINGS), flat_settings=True
+    )
+    # Settings that aren't set on the index are restored to null, so that the defaults apply again
+    previous_settings: JsonBlob = dict.fromkeys(BULK_LOAD_SETTINGS)
+    for index_settings in response.body.values():
+        previous_settings.update(index_settings["settings"])
+    await client.indices.put_settings(index=index, settings=BULK_LOAD_SETTINGS)
+    return previous_settings
 
-    exists_alias = await client.indices.exists_alias(name=index)
-    if not exists_alias:
-        print(f"Did not find index {index} in db, creating index...\n")
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore")
-            #  Get settings and mappings from the mappings.json file
-            mappings = elastic_config.get("mappings")
-            settings = elastic_config.get("settings")
-            index_name = f"{index}-1"
-            try:
-                await client.indices.create(index=index_name, mappings=mappings, settings=settings)
-                await client.indices.put_alias(index=index_name, name=INDEX_ALIAS)
-                # Verify that the new index has been created
-                assert await client.indices.exists(index=index_name)
-                index_and_alias = await client.indices.get_alias(index=index_name)
-                print(index_and_alias)
-            except Exception as e:
-                print(f"Warning: Did not create index {index_name} due to exception {e}\n")
-    else:
-        print(f"Found index {index} in db, skipping index creation...\n")
+
+async def restore_index_after_bulk_load(
+    client: AsyncElasticsearch, index: str, previous_settings: JsonBlob
+) -> None:
+    """Restore the search-time index settings, and merge the segments written during the load"""
+    await client.indices.put_settings(index=index, settings=previous_settings)
+    await client.indices.refresh(index=index)
+    await client.options(request_timeout=600).indices.forcemerge(index=index, max_num_segments=1)
 
 
 async def update_documents_to_index(
-    client: AsyncElasticsearch, index: str, data: list[Wine]
+    client: AsyncElasticsearch, index: str, data: list[JsonBlob]
 ) -> None:
-    await helpers.async_bulk(
-        client,
+    # Send each chunk in as few round trips as possible, capped by `max_chunk_bytes` so that
+    # requests stay well under ES's `http.max_content_length` (100MB by default)
+    num_indexed, errors = await helpers.async_bulk(
+        client.options(request_timeout=120),
         data,
         index=index,
         chunk_size=CHUNKSIZE,
+        max_chunk_bytes=MAX_CHUNK_BYTES,
+        max_retries=3,
+        # Report failed documents and failed requests alongside the successful ones, rather than
+        # raising and abandoning the rest of the chunk
+        raise_on_error=False,
+        raise_on_exception=False,
+        # Only count failures instead of collecting an error response per failed document
+        stats_only=FAST,
     )
-    ids = [item["id"] for item in data]
+    ids = [item["_id"] for item in data]
     print(f"Processed ids in range {min(ids)}-{max(ids)}")
+    num_errors = errors if FAST else len(errors)
+    if num_errors:
+        print(f"Failed to index {num_errors} of {num_indexed + num_errors} documents")
+
+
+async def put_validated(queue: asyncio.Queue, lines: tuple[int, int], future: Future) -> None:
+    try:
+        validated_data = await future
+    except Exception as e:
+        print(f"{e}: Error while validating lines {lines[0]}-{lines[1]}")
+        return
+    await queue.put(validated_data)
 
 
-async def main(data: list[JsonBlob]) -> None:
+async def produce_chunks(
+    data: Iterable[bytes], queue: asyncio.Queue, executor: ProcessPoolExecutor
+) -> None:
+    """Read and validate chunks of data off the event loop, while earlier chunks are being indexed"""
+    loop = asyncio.get_running_loop()
+    chunks = chunk_iterable(data, chunksize=CHUNKSIZE)
+    pending: deque[tuple[tuple[int, int], Future]] = deque()
+    num_lines = 0
+    while chunk := await asyncio.to_thread(next, chunks, None):
+        # Validation is CPU-bound, so run it in worker processes to get around the GIL. The chunk
+        # is sent as a single bytes object, which is far cheaper to pickle than a list of dicts
+        future = loop.run_in_executor(executor, validate, b"\n".join(chunk))
+        pending.append(((num_lines + 1, num_lines + len(chunk)), future))
+        num_lines += len(chunk)
+        # Keep one chunk in flight per worker, and hand over validated chunks in order
+        if len(pending) >= WORKERS:
+            await put_validated(queue, *pending.popleft())
+    while pending:
+        await put_validated(queue, *pending.popleft())
+    # Signal to the consumer that there is no more data
+    await queue.put(None)
+
+
+async def index_chunk(
+    client: AsyncElasticsearch, validated_data: list[JsonBlob], semaphore: asyncio.Semaphore
+) -> None:
+    try:
+        await update_documents_to_index(client, INDEX_ALIAS, validated_data)
+    except Exception as e:
+        ids = [item["_id"] for item in validated_data]
+        print(f"{e}: Error while indexing ID range {min(ids)}-{max(ids)}")
+    finally:
+        semaphore.release()
+
+
+async def consume_chunks(client: AsyncElasticsearch, queue: asyncio.Queue) -> None:
+    # Send up to `CONCURRENCY` bulk requests at a time, so that ES can index them in parallel
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    tasks: set[asyncio.Task] = set()
+    while (validated_data := await queue.get()) is not None:
+        # Wait for a free slot before taking the next chunk off the queue, to apply backpressure
+        await semaphore.acquire()
+        task = asyncio.create_task(index_chunk(client, validated_data, semaphore))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    await asyncio.gather(*tasks)
+
+
+async def main(data: Iterable[bytes]) -> None:
     settings = get_settings()
-    with warnings.catch_warnings():
-        elastic_client = await get_elastic_client(settings)
+    elastic_client = await get_elastic_client(settings)
+    try:
         assert await elastic_client.ping()
         await create_index(elastic_client, INDEX_ALIAS, Path("mapping/mapping.json"))
-        # Validate data and chunk it for ingesting in batches
-        validated_data = validate(data, exclude_none=False)
-        chunked_data = chunk_iterable(validated_data, chunksize=CHUNKSIZE)
-        for chunk in chunked_data:
-            try:
-                ids = [item["id"] for item in chunk]
-                print(f"Finished indexing ID range {min(ids)}-{max(ids)}")
-                await helpers.async_bulk(elastic_client, chunk, index=INDEX_ALIAS)
-            except Exception as e:
-                print(f"{e}: Error while indexing ID range {min(ids)}-{max(ids)}")
+        # Pipeline the ingestion so that the next chunks are read and validated while earlier ones
+        # are being sent to Elasticsearch. The queue buffers one validated chunk per bulk request
+        # slot, so indexing doesn't stall on validation, and its bound caps memory use
+        queue: asyncio.Queue = asyncio.Queue(maxsize=CONCURRENCY)
+        previous_settings = await prepare_index_for_bulk_load(elastic_client, INDEX_ALIAS)
+        try:
+            with ProcessPoolExecutor(max_workers=WORKERS) as executor:
+                await asyncio.gather(
+                    produce_chunks(data, queue, executor),
+                    consume_chunks(elastic_client, queue),
+                )
+        finally:
+            await restore_index_after_bulk_load(elastic_client, INDEX_ALIAS, previous_settings)
+    finally:
         # Close AsyncElasticsearch client
         await elastic_client.close()
 
@@ -153,8 +309,12 @@ if __name__ == "__main__":
     # fmt: off
     parser = argparse.ArgumentParser("Bulk index database from the wine reviews JSONL data")
     parser.add_argument("--limit", type=int, default=0, help="Limit the size of the dataset to load for testing purposes")
-    parser.add_argument("--chunksize", type=int, default=10_000, help="Size of each chunk to break the dataset into before processing")
-    parser.add_argument("--filename", type=str, default="winemag-data-130k-v2.jsonl.gz", help="Name of the JSONL zip file to use")
+    parser.add_argument("--chunksize", type=int, default=int(os.environ.get("BULK_CHUNKSIZE", 12_500)), help="Size of each chunk to break the dataset into before processing")
+    parser.add_argument("--filename", type=str, default="winemag-data-130k-v2.jsonl.gz", help="Name of the JSONL zip file to use (.jsonl.gz or .jsonl.zst)")
+    parser.add_argument("--workers", type=int, default=min(4, os.cpu_count() or 1), help="Number of processes to validate chunks with")
+    parser.add_argument("--max_chunk_bytes", type=int, default=int(os.environ.get("BULK_MAX_CHUNK_BYTES", 50 * 1024 * 1024)), help="Maximum size in bytes of each bulk request sent to Elasticsearch")
+    parser.add_argument("--concurrency", type=int, default=4, help="Maximum number of bulk requests to send to Elasticsearch at a time")
+    parser.add_argument("--fast", action="store_true", help="Only report counts of indexed and failed documents, skipping per-document error details")
     args = vars(parser.parse_args())
     # fmt: on
 
@@ -162,15 +322,19 @@ if __name__ == "__main__":
     DATA_DIR = Path(__file__).parents[3] / "data"
     FILENAME = args["filename"]
     CHUNKSIZE = args["chunksize"]
+    MAX_CHUNK_BYTES = args["max_chunk_bytes"]
+    WORKERS = args["workers"]
+    FAST = args["fast"]
+    CONCURRENCY = args["concurrency"]
 
     # Specify an alias to index the data under
     INDEX_ALIAS = get_settings().elastic_index_alias
     assert INDEX_ALIAS
 
-    data = list(get_json_data(DATA_DIR, FILENAME))
+    data = get_json_data(DATA_DIR, FILENAME)
     if LIMIT > 0:
-        data = data[:LIMIT]
+        data = islice(data, LIMIT)
 
-    # Run main async event loop
-    if data:
-        asyncio.run(main(data))
+    # Run main async event loop using uvloop, for cheaper socket I/O across concurrent bulk requests
+    uvloop.install()
+    asyncio.run(main(data))
@@ -1,3 +1,4 @@
+import msgspec
 from pydantic import BaseModel, ConfigDict, Field, model_validator
 
 
@@ -43,20 +44,55 @@ class Wine(BaseModel):
     taster_twitter_handle: str | None
 
     @model_validator(mode="before")
-    def _fill_country_unknowns(cls, values):
-        "Fill in missing country values with 'Unknown', as we always want this field to be queryable"
+    def _prepare_values(cls, values):
+        """
+        Fill in missing country values with 'Unknown', as we always want this field to be queryable,
+        and create an _id field because Elastic needs this to store as primary key. Both are done in
+        a single pre-validator, so each record is only passed through Python once
+        """
         country = values.get("country")
         if country is None or country == "null":
             values["country"] = "Unknown"
-        return values
-
-    @model_validator(mode="before")
-    def _create_id(cls, values):
-        "Create an _id field because Elastic needs this to store as primary key"
         values["_id"] = values["id"]
         return values
 
 
+class WineStruct(msgspec.Struct):
+    """
+    msgspec mirror of `Wine` for bulk validation: decoding is done in C, so this is much faster
+    than constructing a pydantic model for each of the 130k records
+    """
+
+    id: int
+    points: int
+    title: str
+    description: str | None
+    price: float | None
+    variety: str | None
+    winery: str | None
+    vineyard: str | None = msgspec.field(name="designation")
+    country: str | None
+    province: str | None
+    region_1: str | None
+    region_2: str | None
+    taster_name: str | None
+    taster_twitter_handle: str | None
+
+    def __post_init__(self):
+        for name in STRIPPED_FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                setattr(self, name, value.strip())
+        # Fill in missing country values with 'Unknown'
+        if self.country is None or self.country == "null":
+            self.country = "Unknown"
+
+
+STRIPPED_FIELDS = tuple(
+    name for name, field in Wine.model_fields.items() if field.annotation in (str, str | None)
+)
+
+
 if __name__ == "__main__":
     data = {
         "id": 45100,
@@ -78,3 +114,5 @@ if __name__ == "__main__":
 
     wine = Wine(**data)
     pprint(wine.model_dump(), sort_dicts=False)
+    wine_struct = msgspec.convert(data, WineStruct, strict=False)
+    pprint(msgspec.structs.asdict(wine_struct), sort_dicts=False)
@@ -10,4 +10,7 @@ class Settings(BaseSettings):
     lancedb_dir: str
     api_port: str
     embedding_model_checkpoint: str
+    onnx_model_dir: str = "onnx_model"
+    onnx_num_threads: int = 1
+    num_probes: int = 20
     tag: str
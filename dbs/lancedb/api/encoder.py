@@ -0,0 +1,170 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from pathlib import Path
+
+import numpy as np
+import onnxruntime as ort
+from onnxruntime.quantization import QuantType, quantize_dynamic
+from optimum.onnxruntime import ORTModelForFeatureExtraction
+from transformers import AutoTokenizer
+
+QUANTIZED_MODEL_FILENAME = "model_quantized.onnx"
+
+
+class OnnxSentenceEncoder:
+    """
+    Drop-in replacement for `SentenceTransformer.encode` that runs an int8-quantized ONNX export
+    of the same checkpoint, with mean pooling applied as in the sbert model. Embeddings are
+    L2-normalized by default, as the dot-product metric that the index is searched with requires
+    """
+
+    def __init__(self, model: ORTModelForFeatureExtraction, tokenizer: AutoTokenizer) -> None:
+        self.model = model
+        self.tokenizer = tokenizer
+
+    def encode(
+        self,
+        sentences: str | list[str],
+        batch_size: int | None = None,
+        normalize_embeddings: bool = True,
+    ) -> np.ndarray:
+        if isinstance(sentences, str):
+            return self.encode([sentences], normalize_embeddings=normalize_embeddings)[0]
+        if batch_size is None or len(sentences) <= batch_size:
+            embeddings = self._encode(sentences)
+        else:
+            embeddings = self._encode_sorted(sentences, batch_size)
+        if normalize_embeddings:
+            embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings
+
+    def _encode_sorted(self, sentences: list[str], batch_size: int) -> np.ndarray:
+        # Encode sentences of similar length together, so that each batch has little padding
+        order = np.argsort([len(sentence) for sentence in sentences])
+        batches = [
+            self._encode([sentences[i] for i in order[start : start + batch_size]])
+            for start in range(0, len(sentences), batch_size)
+        ]
+        sorted_embeddings = np.concatenate(batches)
+        embeddings = np.empty_like(sorted_embeddings)
+        embeddings[order] = sorted_embeddings
+        return embeddings
+
+    def _encode(self, sentences: list[str]) -> np.ndarray:
+        inputs = self.tokenizer(sentences, padding=True, truncation=True, return_tensors="np")
+        token_embeddings = self.model(**inputs).last_hidden_state
+        # Mean pooling over the tokens that aren't padding
+        mask = np.expand_dims(inputs["attention_mask"], -1).astype(token_embeddings.dtype)
+        return (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+
+def get_session_options(num_threads: int) -> ort.SessionOptions:
+    """
+    Run each session on a fixed, small number of threads, so that the API's worker processes each
+    own their session and don't contend for cores with one another (or with the event loop)
+    """
+    options = ort.SessionOptions()
+    options.intra_op_num_threads = num_threads
+    options.inter_op_num_threads = 1
+    options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    return options
+
+
+def get_onnx_encoder(
+    model_checkpoint: str, onnx_dir: str, num_threads: int = 1
+) -> OnnxSentenceEncoder:
+    """
+    Export the model checkpoint to ONNX and quantize its weights to int8, the first time this is
+    run, then load the quantized model from `onnx_dir`
+    """
+    onnx_path = Path(onnx_dir)
+    if not (onnx_path / QUANTIZED_MODEL_FILENAME).is_file():
+        model = ORTModelForFeatureExtraction.from_pretrained(model_checkpoint, export=True)
+        model.save_pretrained(onnx_path)
+        AutoTokenizer.from_pretrained(model_checkpoint).save_pretrained(onnx_path)
+        quantize_dynamic(
+            onnx_path / "model.onnx",
+            onnx_path / QUANTIZED_MODEL_FILENAME,
+            weight_type=QuantType.QInt8,
+        )
+    model = ORTModelForFeatureExtraction.from_pretrained(
+        onnx_path,
+        file_name=QUANTIZED_MODEL_FILENAME,
+        provider="CPUExecutionProvider",
+        session_options=get_session_options(num_threads),
+    )
+    tokenizer = AutoTokenizer.from_pretrained(onnx_path)
+    return OnnxSentenceEncoder(model, tokenizer)
+
+
+class BatchingEncoder:
+    """
+    Collects the sentences passed to concurrent `encode` calls over a short window, and embeds
+    them with a single batched call to the underlying encoder
+    """
+
+    def __init__(
+        self, encoder: OnnxSentenceEncoder, max_batch_size: int = 32, max_wait: float = 0.003
+    ) -> None:
+        self.encoder = encoder
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue: queue.Queue[tuple[str, Future] | None] = queue.Queue()
+        # Guards `_closed`, so that nothing can be queued behind the sentinel that `close` puts
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, sentence: str) -> Future:
+        future: Future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("encoder closed")
+            self._queue.put((sentence, future))
+        return future
+
+    def encode(self, sentence: str) -> np.ndarray:
+        return self.submit(sentence).result()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        stopping = False
+        while not stopping and (item := self._queue.get()) is not None:
+            batch = [item]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                try:
+                    item = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            try:
+                embeddings = self.encoder.encode([sentence for sentence, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+        # Fail anything left in the queue, so that no caller is left waiting on its result forever
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is not None:
+                item[1].set_exception(RuntimeError("encoder closed"))
@@ -5,9 +5,10 @@ from functools import lru_cache
 import lancedb
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
-from sentence_transformers import SentenceTransformer
+from fastapi.responses import ORJSONResponse
 
 from api.config import Settings
+from api.encoder import BatchingEncoder, get_onnx_encoder
 from api.routers.rest import router
 
 
@@ -22,12 +23,20 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     """Async context manager for lancedb connection."""
     settings = get_settings()
     model_checkpoint = settings.embedding_model_checkpoint
-    app.model = SentenceTransformer(model_checkpoint)
+    # Serve query embeddings from an int8-quantized ONNX export of the sbert model, batching the
+    # queries from concurrent requests into a single forward pass
+    encoder = get_onnx_encoder(
+        model_checkpoint, settings.onnx_model_dir, num_threads=settings.onnx_num_threads
+    )
+    app.model = BatchingEncoder(encoder)
     # Define LanceDB client
     db = lancedb.connect("./winemag")
     app.table = db.open_table("wines")
+    # Number of IVF partitions to search per query (see scripts/calibrate_nprobes.py)
+    app.num_probes = settings.num_probes
     print("Successfully connected to LanceDB")
     yield
+    app.model.close()
     print("Successfully closed LanceDB connection and released resources")
 
 
@@ -38,6 +47,7 @@ app = FastAPI(
     ),
     version=get_settings().tag,
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 
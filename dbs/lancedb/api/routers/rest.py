@@ -1,26 +1,35 @@
+import asyncio
+from functools import lru_cache
+from typing import Any
+
+import numpy as np
 from fastapi import APIRouter, HTTPException, Query, Request
 
 from api.schemas.rest import CountByCountry, SimilaritySearch
 
 router = APIRouter()
 
-NUM_PROBES = 20
+# Columns returned by the search routes, which leaves out the vector and the distance to the query
+SEARCH_COLUMNS = list(SimilaritySearch.model_fields)
 
 # --- Routes ---
 
 
 @router.get(
     "/search",
-    response_model=list[SimilaritySearch],
+    # Results are projected onto the response schema's columns in Arrow and serialized directly
+    # by ORJSONResponse, so skip validating them again against the response model
+    response_model=None,
+    responses={200: {"model": list[SimilaritySearch]}},
     response_description="Search for wines via semantically similar terms",
 )
-def search_by_similarity(
+async def search_by_similarity(
     request: Request,
     terms: str = Query(
         description="Specify terms to search for in the variety, title and description"
     ),
-) -> list[SimilaritySearch] | None:
-    result = _search_by_similarity(request, terms)
+) -> list[dict[str, Any]] | None:
+    result = await _search_by_similarity(request, terms)
     if not result:
         raise HTTPException(
             status_code=404,
@@ -31,17 +40,18 @@ def search_by_similarity(
 
 @router.get(
     "/search_by_country",
-    response_model=list[SimilaritySearch],
+    response_model=None,
+    responses={200: {"model": list[SimilaritySearch]}},
     response_description="Search for wines via semantically similar terms from a particular country",
 )
-def search_by_similarity_and_country(
+async def search_by_similarity_and_country(
     request: Request,
     terms: str = Query(
         description="Specify terms to search for in the variety, title and description"
     ),
     country: str = Query(description="Country name to search for wines from"),
-) -> list[SimilaritySearch] | None:
-    result = _search_by_similarity_and_country(request, terms, country)
+) -> list[dict[str, Any]] | None:
+    result = await _search_by_similarity_and_country(request, terms, country)
     if not result:
         raise HTTPException(
             status_code=404,
@@ -52,10 +62,11 @@ def search_by_similarity_and_country(
 
 @router.get(
     "/search_by_filters",
-    response_model=list[SimilaritySearch],
+    response_model=None,
+    responses={200: {"model": list[SimilaritySearch]}},
     response_description="Search for wines via semantically similar terms with added filters",
 )
-def search_by_similarity_and_filters(
+async def search_by_similarity_and_filters(
     request: Request,
     terms: str = Query(
         description="Specify terms to search for in the variety, title and description"
@@ -63,8 +74,8 @@ def search_by_similarity_and_filters(
     country: str = Query(description="Country name to search for wines from"),
     points: int = Query(default=85, description="Minimum number of points for a wine"),
     price: float = Query(default=100.0, description="Maximum price for a wine"),
-) -> list[SimilaritySearch] | None:
-    result = _search_by_similarity_and_filters(request, terms, country, points, price)
+) -> list[dict[str, Any]] | None:
+    result = await _search_by_similarity_and_filters(request, terms, country, points, price)
     if not result:
         raise HTTPException(
             status_code=404,
@@ -78,11 +89,11 @@ def search_by_similarity_and_filters(
     response_model=CountByCountry,
     response_description="Get counts of wine for a particular country",
 )
-def count_by_country(
+async def count_by_country(
     request: Request,
     country: str = Query(description="Country name to get counts for"),
 ) -> CountByCountry:
-    result = _count_by_country(request, country)
+    result = await _count_by_country(request, country)
     if not result:
         raise HTTPException(
             status_code=404,
@@ -96,13 +107,13 @@ def count_by_country(
     response_model=CountByCountry,
     response_description="Get counts of wine for a particular country, filtered by points and price",
 )
-def count_by_filters(
+async def count_by_filters(
     request: Request,
     country: str = Query(description="Country name to get counts for"),
     points: int = Query(default=85, description="Minimum number of points for a wine"),
     price: float = Query(default=100.0, description="Maximum price for a wine"),
 ) -> CountByCountry:
-    result = _count_by_filters(request, country, points, price)
+    result = await _count_by_filters(request, country, points, price)
     if not result:
         raise HTTPException(
             status_code=404,
@@ -114,102 +125,101 @@ def count_by_filters(
 # --- Helper functions ---
 
 
-def _search_by_similarity(
+@lru_cache(maxsize=1024)
+def _build_filter(country: str, points: int | None = None, price: float | None = None) -> str:
+    "Build the SQL filter for a given set of parameters once, escaping quotes in the country name"
+    country = country.replace("'", "''")
+    conditions = [f"country = '{country}'"]
+    if points is not None:
+        conditions.append(f"points >= {int(points)}")
+    if price is not None:
+        conditions.append(f"price <= {float(price)}")
+    return " and ".join(conditions)
+
+
+@lru_cache(maxsize=4096)
+def _embed(model, terms: str) -> np.ndarray:
+    "Memoize query embeddings, as popular search terms are repeated often"
+    # Query embeddings are L2-normalized like the stored ones, so the dot product ranks as cosine
+    query_vector = model.encode(terms)
+    # The same array is handed out to every caller, so guard it against in-place changes
+    query_vector.flags.writeable = False
+    return query_vector
+
+
+async def _search_by_similarity(
     request: Request,
     terms: str,
-) -> list[SimilaritySearch] | None:
-    query_vector = request.app.model.encode(terms.lower())
-    search_result = (
-        request.app.table.search(query_vector).metric("cosine").nprobes(NUM_PROBES).limit(5).to_df()
-    ).to_dict(orient="records")
+) -> list[dict[str, Any]] | None:
+    query_vector = await asyncio.to_thread(_embed, request.app.model, terms.lower())
+    query = (
+        request.app.table.search(query_vector)
+        .metric("dot")
+        .nprobes(request.app.num_probes)
+        .limit(5)
+    )
+    # The LanceDB client is synchronous, so run the search in a thread to keep the event loop free
+    search_result = (await asyncio.to_thread(query.to_arrow)).select(SEARCH_COLUMNS).to_pylist()
     if not search_result:
         return None
     return search_result
 
 
-def _search_by_similarity_and_country(
+async def _search_by_similarity_and_country(
     request: Request, terms: str, country: str
-) -> list[SimilaritySearch] | None:
-    query_vector = request.app.model.encode(terms.lower())
-    search_result = (
+) -> list[dict[str, Any]] | None:
+    query_vector = await asyncio.to_thread(_embed, request.app.model, terms.lower())
+    query = (
         request.app.table.search(query_vector)
-        .metric("cosine")
-        .nprobes(NUM_PROBES)
-        .where(
-            f"""
-            country = '{country}'
-            """
-        )
+        .metric("dot")
+        .nprobes(request.app.num_probes)
+        .where(_build_filter(country), prefilter=True)
         .limit(5)
-        .to_df()
-    ).to_dict(orient="records")
+    )
+    search_result = (await asyncio.to_thread(query.to_arrow)).select(SEARCH_COLUMNS).to_pylist()
     if not search_result:
         return None
     return search_result
 
 
-def _search_by_similarity_and_filters(
+async def _search_by_similarity_and_filters(
     request: Request,
     terms: str,
     country: str,
     points: int,
     price: float,
-) -> list[SimilaritySearch] | None:
-    query_vector = request.app.model.encode(terms.lower())
-    price = float(price)
-    search_result = (
+) -> list[dict[str, Any]] | None:
+    query_vector = await asyncio.to_thread(_embed, request.app.model, terms.lower())
+    query = (
         request.app.table.search(query_vector)
-        .metric("cosine")
-        .nprobes(NUM_PROBES)
-        .where(
-            f"""
-            country = '{country}'
-            and points >= {points}
-            and price <= {price}
-            """
-        )
+        .metric("dot")
+        .nprobes(request.app.num_probes)
+        .where(_build_filter(country, points, price), prefilter=True)
         .limit(5)
-        .to_df()
-    ).to_dict(orient="records")
+    )
+    search_result = (await asyncio.to_thread(query.to_arrow)).select(SEARCH_COLUMNS).to_pylist()
     if not search_result:
         return None
     return search_result
 
 
-def _count_by_country(
+async def _count_by_country(
     request: Request,
     country: str,
 ) -> CountByCountry:
-    search_result = (
-        request.app.table.search()
-        .where(
-            f"""
-            country = '{country}'
-            """
-        )
-        .to_df()
-    ).shape[0]
+    query = request.app.table.search().where(_build_filter(country))
+    search_result = (await asyncio.to_thread(query.to_arrow)).num_rows
     final_result = CountByCountry(count=search_result)
     return final_result
 
 
-def _count_by_filters(
+async def _count_by_filters(
     request: Request,
     country: str,
     points: int,
     price: float,
 ) -> CountByCountry:
-    price = float(price)
-    search_result = (
-        request.app.table.search()
-        .where(
-            f"""
-            country = '{country}'
-            and points >= {points}
-            and price <= {price}
-            """
-        )
-        .to_df()
-    ).shape[0]
+    query = request.app.table.search().where(_build_filter(country, points, price))
+    search_result = (await asyncio.to_thread(query.to_arrow)).num_rows
     final_result = CountByCountry(count=search_result)
     return final_result
@@ -1,22 +1,39 @@
 import argparse
+import io
+import math
 import os
 import sys
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import threading
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 from functools import lru_cache
+from itertools import islice
 from pathlib import Path
-from typing import Any, Iterator
+from typing import Any, Iterable, Iterator
 
 import lancedb
-import pandas as pd
-import srsly
+import numpy as np
+import orjson
+import pyarrow as pa
+import torch
 from codetiming import Timer
 from dotenv import load_dotenv
+from isal import igzip
 from lancedb.pydantic import pydantic_to_schema
+from pydantic import TypeAdapter
 from sentence_transformers import SentenceTransformer
 from tqdm import tqdm
 
 sys.path.insert(1, os.path.realpath(Path(__file__).resolve().parents[1]))
 from api.config import Settings
+from api.encoder import OnnxSentenceEncoder, get_onnx_encoder
 from schemas.wine import LanceModelWine, Wine
 
 
@@ -24,6 +41,17 @@ load_dotenv()
 # Custom types
 JsonBlob = dict[str, Any]
 
+WINE_LIST_ADAPTER = TypeAdapter(list[Wine])
+TABLE_SCHEMA = pydantic_to_schema(LanceModelWine)
+VECTOR_INDEX = TABLE_SCHEMA.get_field_index("vector")
+# Schema of the scalar columns, which are built from the validated records
+ROW_SCHEMA = TABLE_SCHEMA.remove(VECTOR_INDEX)
+# Holds the sentence embedding model, loaded by `init_worker` in each worker process or thread.
+# Worker threads each get their own copy, as Hugging Face fast tokenizers aren't thread-safe
+WORKER = threading.local()
+# Worker threads load their models one at a time, so only the first exports the ONNX model
+LOAD_LOCK = threading.Lock()
+
 
 class FileNotFoundError(Exception):
     pass
@@ -35,88 +63,166 @@ def get_settings():
     return Settings()
 
 
-def chunk_iterable(item_list: list[JsonBlob], chunksize: int) -> Iterator[list[JsonBlob]]:
+def chunk_iterable(items: Iterable[JsonBlob], chunksize: int) -> Iterator[tuple[JsonBlob, ...]]:
     """
     Break a large iterable into an iterable of smaller iterables of size `chunksize`
     """
-    for i in range(0, len(item_list), chunksize):
-        yield item_list[i : i + chunksize]
+    iterator = iter(items)
+    while chunk := tuple(islice(iterator, chunksize)):
+        yield chunk
+
 
+def read_gzip_jsonl(file_path: Path) -> Iterator[JsonBlob]:
+    """Stream records from a gzipped line-delimited json file (.jsonl.gz)"""
+    # Read the decompressed stream through a 1 MiB buffer and parse each line with orjson
+    # ISA-L's SIMD-accelerated inflate is a drop-in for the stdlib gzip module, at 2-3x the speed
+    with igzip.open(file_path, "rb") as fh:
+        for line in io.BufferedReader(fh, buffer_size=1 << 20):
+            if line := line.strip():
+                yield orjson.loads(line)
 
-def get_json_data(data_dir: Path, filename: str) -> list[JsonBlob]:
-    """Get all line-delimited json files (.jsonl) from a directory with a given prefix"""
+
+def get_json_data(data_dir: Path, filename: str) -> Iterator[JsonBlob]:
+    """Lazily read records from a gzipped line-delimited json file (.jsonl.gz)"""
     file_path = data_dir / filename
     if not file_path.is_file():
-        # File may not have been uncompressed yet so try to do that first
-        data = srsly.read_gzip_jsonl(file_path)
-        # This time if it isn't there it really doesn't exist
-        if not file_path.is_file():
-            raise FileNotFoundError(f"No valid .jsonl file found in `{data_dir}`")
-    else:
-        data = srsly.read_gzip_jsonl(file_path)
-    return data
+        raise FileNotFoundError(f"No valid .jsonl file found in `{data_dir}`")
+    return read_gzip_jsonl(file_path)
+
+
+def add_to_vectorize(data: Iterable[JsonBlob]) -> None:
+    "Add a lowercased field to_vectorize to each item, used to create its sentence embedding"
+    for item in data:
+        fields = (item.get("variety"), item.get("title"), item.get("description"))
+        item["to_vectorize"] = " ".join(filter(None, fields)).strip().lower()
 
 
 def validate(
     data: list[JsonBlob],
     exclude_none: bool = False,
 ) -> list[JsonBlob]:
-    validated_data = [Wine(**item).model_dump(exclude_none=exclude_none) for item in data]
+    add_to_vectorize(data)
+    # Validate and dump the whole chunk in single calls into pydantic-core, rather than per record
+    wines = WINE_LIST_ADAPTER.validate_python(data)
+    validated_data = WINE_LIST_ADAPTER.dump_python(wines, exclude_none=exclude_none)
     return validated_data
 
 
-def embed_func(batch: list[str], model) -> list[list[float]]:
-    return [model.encode(sentence.lower()) for sentence in batch]
-
-
-def vectorize_text(data: list[JsonBlob]) -> list[LanceModelWine] | None:
-    # Load a sentence transformer model for semantic similarity from a specified checkpoint
-    model_id = get_settings().embedding_model_checkpoint
+def init_worker(device: str = "cpu", onnx: bool = False) -> None:
+    "Load the sentence transformer model once per worker, rather than once per chunk"
+    settings = get_settings()
+    model_id = settings.embedding_model_checkpoint
     assert model_id, "Invalid embedding model checkpoint specified in .env file"
-    MODEL = SentenceTransformer(model_id)
+    with LOAD_LOCK:
+        if onnx:
+            # Reuse the int8-quantized ONNX export that the API serves query embeddings from. Each
+            # call runs on the calling thread alone, so concurrent workers don't oversubscribe cores
+            WORKER.model = get_onnx_encoder(
+                model_id, f"../{settings.onnx_model_dir}", num_threads=1
+            )
+        else:
+            WORKER.model = SentenceTransformer(model_id, device=device)
+
+
+def embed_func(batch: list[str], model, batch_size: int = 64) -> np.ndarray:
+    # Encode the whole chunk in padded mini-batches, rather than one forward pass per sentence.
+    # `encode` sorts the sentences by length internally, so each mini-batch has little padding
+    if isinstance(model, OnnxSentenceEncoder):
+        embeddings = model.encode(batch, batch_size=batch_size, normalize_embeddings=True)
+    else:
+        embeddings = model.encode(
+            batch,
+            batch_size=batch_size,
+            show_progress_bar=False,
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+        )
+    return embeddings
+
 
-    ids = [item["id"] for item in data]
+def vectorize_text(data: list[JsonBlob], batch_size: int = 64) -> pa.Table | None:
     to_vectorize = [text.get("to_vectorize") for text in data]
-    vectors = embed_func(to_vectorize, MODEL)
+    vectors = embed_func(to_vectorize, WORKER.model, batch_size=batch_size)
     try:
-        data_batch = [{**d, "vector": vector} for d, vector in zip(data, vectors)]
+        # Build the Arrow columns directly, with the vectors wrapping the embedding array's buffer
+        # as a fixed-size list column, rather than going through a DataFrame of per-row arrays
+        vector_column = pa.FixedSizeListArray.from_arrays(
+            pa.array(vectors.ravel()), vectors.shape[1]
+        )
+        table = pa.Table.from_pylist(data, schema=ROW_SCHEMA)
+        table = table.add_column(VECTOR_INDEX, TABLE_SCHEMA.field(VECTOR_INDEX), vector_column)
     except Exception as e:
+        ids = [item["id"] for item in data]
         print(f"{e}: Failed to add ID range {min(ids)}-{max(ids)}")
         return None
-    return data_batch
+    return table
 
 
-def embed_batches(tbl: str, validated_data: list[JsonBlob]) -> pd.DataFrame:
-    with ProcessPoolExecutor(max_workers=WORKERS) as executor:
-        chunked_data = chunk_iterable(validated_data, CHUNKSIZE)
-        embed_data = []
-        for chunk in tqdm(chunked_data, total=len(validated_data) // CHUNKSIZE):
-            futures = [executor.submit(vectorize_text, chunk)]
-            embed_data = [f.result() for f in as_completed(futures) if f.result()][0]
-            df = pd.DataFrame.from_dict(embed_data)
-            tbl.add(df, mode="overwrite")
+def collect_tables(futures: Iterable[Future], tables: list[pa.Table]) -> None:
+    for future in futures:
+        if (table := future.result()) is not None:
+            tables.append(table)
 
 
-def main(data: list[JsonBlob]) -> None:
+def embed_batches(data: Iterable[JsonBlob]) -> pa.Table:
+    """
+    Embed all the data chunk by chunk and return it as one Arrow table, so that it can be written
+    to LanceDB in a single call rather than adding a new set of fragments per chunk
+    """
+    use_gpu = torch.cuda.is_available() and not ONNX
+    executor: Executor
+    if use_gpu or ONNX:
+        # CUDA kernels and ONNX Runtime sessions both release the GIL while they run, so worker
+        # threads can overlap tokenization and Arrow conversion with inference, without pickling
+        # each chunk and its embeddings across processes
+        executor = ThreadPoolExecutor(
+            max_workers=WORKERS,
+            initializer=init_worker,
+            initargs=("cuda" if use_gpu else "cpu", ONNX),
+        )
+    else:
+        executor = ProcessPoolExecutor(
+            max_workers=WORKERS, initializer=init_worker, initargs=("cpu", False)
+        )
+    # Use larger batches on a GPU to keep it busy
+    batch_size = 256 if use_gpu else 64
+    tables: list[pa.Table] = []
+    with executor:
+        # Validate and submit chunks as they're read from file, keeping no more than a couple of
+        # chunks per worker in flight so that the raw json is never held in memory all at once
+        pending: set[Future] = set()
+        for chunk in tqdm(chunk_iterable(data, CHUNKSIZE)):
+            if len(pending) >= 2 * WORKERS:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect_tables(done, tables)
+            validated = validate(chunk, exclude_none=False)
+            pending.add(executor.submit(vectorize_text, validated, batch_size=batch_size))
+        collect_tables(as_completed(pending), tables)
+    return pa.concat_tables(tables)
+
+
+def main(data: Iterable[JsonBlob]) -> None:
     DB_NAME = f"../{get_settings().lancedb_dir}"
     TABLE = "wines"
     db = lancedb.connect(DB_NAME)
 
-    tbl = db.create_table(TABLE, schema=pydantic_to_schema(LanceModelWine), mode="overwrite")
+    tbl = db.create_table(TABLE, schema=TABLE_SCHEMA, mode="overwrite")
     print(f"Created table `{TABLE}`, with length {len(tbl)}")
 
-    with Timer(name="Bulk Index", text="Validated data using Pydantic in {:.4f} sec"):
-        validated_data = validate(data, exclude_none=False)
-
-    with Timer(name="Embed batches", text="Created sentence embeddings in {:.4f} sec"):
-        embed_batches(tbl, validated_data)
+    with Timer(name="Embed batches", text="Validated data and created embeddings in {:.4f} sec"):
+        tbl.add(embed_batches(data))
 
     print(f"Finished inserting {len(tbl)} items into LanceDB table")
 
     with Timer(name="Create index", text="Created IVF-PQ index in {:.4f} sec"):
-        # Creating index (choose num partitions as a power of 2 that's closest to len(dataset) // 5000)
-        # In this case, we have 130k datapoints, so the nearest power of 2 is 130000//5000 ~ 32)
-        tbl.create_index(metric="cosine", num_partitions=4, num_sub_vectors=32)
+        # Choose num partitions as the power of 2 nearest to sqrt(len(dataset)) on a log scale,
+        # which is 256 for 130k datapoints (sqrt ~360), and split each 384-d vector into 48
+        # sub-vectors of 8 dims for PQ compression
+        # The number of partitions probed per query is then calibrated via calibrate_nprobes.py
+        # Embeddings are unit-norm, so the dot product ranks results exactly as cosine similarity
+        # does, without normalizing vectors at each distance computation
+        num_partitions = 2 ** round(math.log2(math.sqrt(len(tbl))))
+        tbl.create_index(metric="dot", num_partitions=num_partitions, num_sub_vectors=48)
 
 
 if __name__ == "__main__":
@@ -126,6 +232,7 @@ if __name__ == "__main__":
     parser.add_argument("--chunksize", type=int, default=1000, help="Size of each chunk to break the dataset into before processing")
     parser.add_argument("--filename", type=str, default="winemag-data-130k-v2.jsonl.gz", help="Name of the JSONL zip file to use")
     parser.add_argument("--workers", type=int, default=4, help="Number of workers to use for vectorization")
+    parser.add_argument("--onnx", action="store_true", help="Embed with the int8-quantized ONNX export of the model on CPU, instead of PyTorch")
     args = vars(parser.parse_args())
     # fmt: on
 
@@ -134,9 +241,11 @@ if __name__ == "__main__":
     FILENAME = args["filename"]
     CHUNKSIZE = args["chunksize"]
     WORKERS = args["workers"]
+    ONNX = args["onnx"]
+
+    data = get_json_data(DATA_DIR, FILENAME)
+    if LIMIT > 0:
+        data = islice(data, LIMIT)
 
-    data = list(get_json_data(DATA_DIR, FILENAME))
-    assert data, "No data found in the specified file"
-    data = data[:LIMIT] if LIMIT > 0 else data
     main(data)
     print("Finished execution!")
@@ -0,0 +1,83 @@
+import argparse
+import os
+import sys
+from functools import lru_cache
+from pathlib import Path
+
+import lancedb
+import numpy as np
+from dotenv import load_dotenv
+from sentence_transformers import SentenceTransformer
+
+sys.path.insert(1, os.path.realpath(Path(__file__).resolve().parents[1]))
+from api.config import Settings
+
+load_dotenv()
+
+# Representative search terms, used as held-out queries to measure recall against
+QUERIES = [
+    "tuscany red",
+    "fruity and fresh white wine",
+    "bold cabernet with dark berries",
+    "crisp sauvignon blanc with citrus notes",
+    "earthy pinot noir with mushroom",
+    "sweet dessert wine with honey",
+    "sparkling wine for celebrations",
+    "oaky chardonnay with butter and vanilla",
+    "spicy zinfandel with pepper",
+    "light rose with strawberry",
+    "full-bodied malbec from argentina",
+    "mineral riesling with high acidity",
+]
+
+
+@lru_cache()
+def get_settings():
+    # Use lru_cache to avoid loading .env file for every request
+    return Settings()
+
+
+def exact_top_k(vectors: np.ndarray, ids: np.ndarray, query: np.ndarray, k: int) -> set[int]:
+    "Brute-force cosine similarity over all vectors, as the ground truth for recall"
+    scores = vectors @ query / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query))
+    return set(ids[np.argsort(-scores)[:k]].tolist())
+
+
+def main(nprobes_values: list[int], k: int, target_recall: float) -> None:
+    db = lancedb.connect(f"../{get_settings().lancedb_dir}")
+    tbl = db.open_table("wines")
+    data = tbl.to_arrow()
+    vectors = np.stack(data["vector"].to_numpy(zero_copy_only=False))
+    ids = data["id"].to_numpy()
+
+    model = SentenceTransformer(get_settings().embedding_model_checkpoint)
+    # Normalize the queries as the stored vectors are, for the index's dot-product metric
+    query_vectors = model.encode(QUERIES, normalize_embeddings=True)
+    ground_truth = [exact_top_k(vectors, ids, query, k) for query in query_vectors]
+
+    best = None
+    for nprobes in sorted(nprobes_values):
+        recalls = []
+        for query, expected in zip(query_vectors, ground_truth):
+            result = tbl.search(query).metric("dot").nprobes(nprobes).limit(k).to_arrow()
+            recalls.append(len(expected & set(result["id"].to_pylist())) / k)
+        recall = float(np.mean(recalls))
+        print(f"nprobes={nprobes}: recall@{k}={recall:.3f}")
+        if best is None and recall >= target_recall:
+            best = nprobes
+    if best is None:
+        print(f"No value of nprobes reached a recall@{k} of {target_recall}")
+    else:
+        print(f"Set NUM_PROBES={best} in .env to reach a recall@{k} of at least {target_recall}")
+
+
+if __name__ == "__main__":
+    # fmt: off
+    parser = argparse.ArgumentParser("Find the smallest number of IVF partitions to probe for a target recall")
+    parser.add_argument("--nprobes", type=int, nargs="+", default=[4, 8, 12, 16, 20], help="Values of nprobes to sweep")
+    parser.add_argument("--k", type=int, default=5, help="Number of results to compute recall over")
+    parser.add_argument("--target_recall", type=float, default=0.95, help="Minimum acceptable recall@k")
+    args = vars(parser.parse_args())
+    # fmt: on
+
+    main(args["nprobes"], args["k"], args["target_recall"])
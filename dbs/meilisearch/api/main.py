@@ -2,8 +2,10 @@ from collections.abc import AsyncGenerator
 from contextlib import asynccontextmanager
 from functools import lru_cache
 
+import httpx
 from fastapi import FastAPI
 from meilisearch_python_async import Client
+from meilisearch_python_async.index import Index
 
 from api.config import Settings
 from api.routers import rest
@@ -32,8 +34,16 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     print(settings)
     search_key = await get_search_api_key(settings)
     URI = f"http://{settings.meili_service}:{settings.meili_port}"
-    async with Client(URI, search_key) as client:
-        app.client = client
+    # Searches go through a single, long-lived connection pool shared by all requests, so that
+    # each one reuses a kept-alive connection rather than opening its own
+    http_client = httpx.AsyncClient(
+        base_url=URI,
+        headers={"Authorization": f"Bearer {search_key}"},
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=64),
+    )
+    async with http_client:
+        # Create the index handle once, rather than on every request
+        app.index = Index(http_client, "wines")
         print("Successfully connected to Meilisearch")
         yield
         print("Successfully closed Meilisearch connection")
@@ -1,20 +1,27 @@
+import msgspec
 from api.schemas.rest import (
     FullTextSearch,
+    FullTextSearchStruct,
     TopWinesByCountry,
+    TopWinesByCountryStruct,
     TopWinesByProvince,
+    TopWinesByProvinceStruct,
 )
-from fastapi import APIRouter, HTTPException, Query, Request
-from meilisearch_python_async import Client
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from meilisearch_python_async.index import Index
 
 router = APIRouter()
 
+encode_json = msgspec.json.Encoder().encode
+
 
 # --- Routes ---
 
 
 @router.get(
     "/search",
-    response_model=list[FullTextSearch],
+    response_model=None,
+    responses={200: {"model": list[FullTextSearch]}},
     response_description="Search wines by title, description and variety",
 )
 async def search_by_keywords(
@@ -23,19 +30,20 @@ async def search_by_keywords(
     max_price: int = Query(
         default=100.0, description="Specify the maximum price for the wine (e.g., 30)"
     ),
-) -> list[FullTextSearch] | None:
-    result = await _search_by_keywords(request.app.client, terms, max_price)
+) -> Response:
+    result = await _search_by_keywords(request.app.index, terms, max_price)
     if not result:
         raise HTTPException(
             status_code=404,
             detail=f"No wine with the provided terms '{terms}' found in database - please try again",
         )
-    return result
+    return Response(content=encode_json(result), media_type="application/json")
 
 
 @router.get(
     "/top_by_country",
-    response_model=list[TopWinesByCountry],
+    response_model=None,
+    responses={200: {"model": list[TopWinesByCountry]}},
     response_description="Get top-rated wines by country",
 )
 async def top_by_country(
@@ -43,19 +51,20 @@ async def top_by_country(
     country: str = Query(
         description="Get top-rated wines by country name specified (must be exact name)"
     ),
-) -> list[TopWinesByCountry] | None:
-    result = await _top_by_country(request.app.client, country)
+) -> Response:
+    result = await _top_by_country(request.app.index, country)
     if not result:
         raise HTTPException(
             status_code=404,
             detail=f"No wine from the provided country '{country}' found in database - please enter exact country name",
         )
-    return result
+    return Response(content=encode_json(result), media_type="application/json")
 
 
 @router.get(
     "/top_by_province",
-    response_model=list[TopWinesByProvince],
+    response_model=None,
+    responses={200: {"model": list[TopWinesByProvince]}},
     response_description="Get top-rated wines by province",
 )
 async def top_by_province(
@@ -63,60 +72,55 @@ async def top_by_province(
     province: str = Query(
         description="Get top-rated wines by province name specified (must be exact name)"
     ),
-) -> list[TopWinesByProvince] | None:
-    result = await _top_by_province(request.app.client, province)
+) -> Response:
+    result = await _top_by_province(request.app.index, province)
     if not result:
         raise HTTPException(
             status_code=404,
             detail=f"No wine from the provided province '{province}' found in database - please enter exact province name",
         )
-    return result
+    return Response(content=encode_json(result), media_type="application/json")
 
 
 # --- Meilisearch query funcs ---
 
 
 async def _search_by_keywords(
-    client: Client, terms: str, max_price: int, index="wines"
-) -> list[FullTextSearch] | None:
-    index = client.index(index)
+    index: Index, terms: str, max_price: int
+) -> list[FullTextSearchStruct] | None:
     response = await index.search(
         terms,
         limit=5,
         filter=f"price < {max_price}",
         sort=["points:desc", "price:asc"],
+        attributes_to_retrieve=list(FullTextSearchStruct.__struct_fields__),
     )
     if response:
-        return response.hits
+        return msgspec.convert(response.hits, list[FullTextSearchStruct])
     return None
 
 
-async def _top_by_country(
-    client: Client, country: str, index="wines"
-) -> list[TopWinesByCountry] | None:
-    index = client.index(index)
+async def _top_by_country(index: Index, country: str) -> list[TopWinesByCountryStruct] | None:
     response = await index.search(
         "",
         limit=5,
         filter=f'country = "{country}"',
         sort=["points:desc", "price:asc"],
+        attributes_to_retrieve=list(TopWinesByCountryStruct.__struct_fields__),
     )
     if response:
-        print(response.hits)
-        return response.hits
+        return msgspec.convert(response.hits, list[TopWinesByCountryStruct])
     return None
 
 
-async def _top_by_province(
-    client: Client, province: str, index="wines"
-) -> list[TopWinesByProvince] | None:
-    index = client.index(index)
+async def _top_by_province(index: Index, province: str) -> list[TopWinesByProvinceStruct] | None:
     response = await index.search(
         "terms",
         limit=5,
         filter=f'province = "{province}"',
         sort=["points:desc", "price:asc"],
+        attributes_to_retrieve=list(TopWinesByProvinceStruct.__struct_fields__),
     )
     if response:
-        return response.hits
+        return msgspec.convert(response.hits, list[TopWinesByProvinceStruct])
     return None
@@ -1,3 +1,4 @@
+import msgspec
 from pydantic import BaseModel, ConfigDict
 
 
@@ -56,3 +57,41 @@ class TopWinesByProvince(BaseModel):
     price: float | str | None = "Not available"
     variety: str | None
     winery: str | None
+
+
+# msgspec mirrors of the response models above, which the routes use to filter and serialize the
+# search hits in C, while the pydantic models document the responses in the OpenAPI schema
+
+
+class FullTextSearchStruct(msgspec.Struct, kw_only=True):
+    id: int
+    country: str
+    title: str
+    description: str | None = None
+    points: int
+    price: float | str | None = None
+    variety: str | None = None
+    winery: str | None = None
+
+
+class TopWinesByCountryStruct(msgspec.Struct, kw_only=True):
+    id: int
+    country: str
+    title: str
+    description: str | None = None
+    points: int
+    price: float | str | None = "Not available"
+    variety: str | None = None
+    winery: str | None = None
+
+
+class TopWinesByProvinceStruct(msgspec.Struct, kw_only=True):
+    id: int
+    country: str
+    province: str
+    title: str
+    description: str | None = None
+    points: int
+    price: float | str | None = "Not available"
+    variety: str | None = None
+    winery: str | None = None
@@ -1,3 +1,4 @@
+import msgspec
 from pydantic import BaseModel, ConfigDict, Field, model_validator
 
 
@@ -51,6 +52,42 @@ class Wine(BaseModel):
         return values
 
 
+class WineStruct(msgspec.Struct):
+    """
+    msgspec mirror of `Wine`, used to validate whole batches of records in C rather than
+    constructing a pydantic model per record
+    """
+
+    id: int
+    points: int
+    title: str
+    description: str | None
+    price: float | None
+    variety: str | None
+    winery: str | None
+    vineyard: str | None = msgspec.field(name="designation")
+    country: str | None
+    province: str | None
+    region_1: str | None
+    region_2: str | None
+    taster_name: str | None
+    taster_twitter_handle: str | None
+
+    def __post_init__(self):
+        # Match `str_strip_whitespace` and `_fill_country_unknowns` on the pydantic model
+        for name in STRIPPED_FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                setattr(self, name, value.strip())
+        if self.country is None or self.country == "null":
+            self.country = "Unknown"
+
+
+STRIPPED_FIELDS = tuple(
+    name for name, field in Wine.model_fields.items() if field.annotation in (str, str | None)
+)
+
+
 if __name__ == "__main__":
     data = {
         "id": 45100,
@@ -72,3 +109,5 @@ if __name__ == "__main__":
 
     wine = Wine(**data)
     pprint(wine.model_dump(), sort_dicts=False)
+    wine_struct = msgspec.convert(data, WineStruct, strict=False)
+    pprint(msgspec.structs.asdict(wine_struct), sort_dicts=False)
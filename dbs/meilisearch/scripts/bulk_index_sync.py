@@ -1,18 +1,21 @@
 from __future__ import annotations
 
 import argparse
+import io
 import os
 import sys
 from functools import lru_cache
+from itertools import islice
 from pathlib import Path
-from typing import Any
+from typing import Any, Iterable, Iterator
 
-import srsly
+import msgspec
 from codetiming import Timer
 from dotenv import load_dotenv
+from isal import igzip
 from meilisearch import Client
 from meilisearch.index import Index
-from schemas.wine import Wine
+from schemas.wine import WineStruct
 from tqdm import tqdm
 
 sys.path.insert(1, os.path.realpath(Path(__file__).resolve().parents[1]))
@@ -22,6 +25,9 @@ load_dotenv()
 # Custom types
 JsonBlob = dict[str, Any]
 
+decode_wines = msgspec.json.Decoder(WineStruct, strict=False).decode_lines
+encode_json = msgspec.json.Encoder().encode
+
 
 class FileNotFoundError(Exception):
     pass
@@ -36,49 +42,77 @@ def get_settings():
     return Settings()
 
 
-def get_json_data(file_path: Path) -> list[JsonBlob]:
-    """Get all line-delimited json files (.jsonl) from a directory with a given prefix"""
+def chunk_iterable(items: Iterable[bytes], chunksize: int) -> Iterator[tuple[bytes, ...]]:
+    """
+    Break a large iterable into an iterable of smaller iterables of size `chunksize`
+    """
+    iterator = iter(items)
+    while chunk := tuple(islice(iterator, chunksize)):
+        yield chunk
+
+
+def read_gzip_jsonl(file_path: Path) -> Iterator[bytes]:
+    """Stream raw lines of json from a gzipped line-delimited json file (.jsonl.gz)"""
+    # Read the decompressed stream through a 1 MiB buffer, leaving lines to be parsed in batches
+    with igzip.open(file_path, "rb") as fh:
+        for line in io.BufferedReader(fh, buffer_size=1 << 20):
+            if line := line.strip():
+                yield line
+
+
+def get_data_files(data_dir: Path) -> list[Path]:
+    """List the .jsonl.gz files in a directory, in sorted order"""
+    # A single scandir pass gets each entry's type along with its name, so no extra stat calls
+    with os.scandir(data_dir) as entries:
+        return sorted(
+            Path(entry.path)
+            for entry in entries
+            if entry.name.endswith(".jsonl.gz") and entry.is_file()
+        )
+
+
+def get_json_data(file_path: Path) -> Iterator[bytes]:
+    """Lazily read lines from a gzipped line-delimited json file (.jsonl.gz)"""
     if not file_path.is_file():
-        # File may not have been uncompressed yet so try to do that first
-        data = srsly.read_gzip_jsonl(file_path)
-        # This time if it isn't there it really doesn't exist
-        if not file_path.is_file():
-            raise FileNotFoundError(
-                f"`{file_path}` doesn't contain a valid `.jsonl.gz` file - check and try again."
-            )
-    else:
-        data = srsly.read_gzip_jsonl(file_path)
-    return data
+        raise FileNotFoundError(
+            f"`{file_path}` doesn't contain a valid `.jsonl.gz` file - check and try again."
+        )
+    return read_gzip_jsonl(file_path)
 
 
 def validate(
-    data: list[JsonBlob],
+    data: tuple[bytes, ...],
     exclude_none: bool = True,
 ) -> list[JsonBlob]:
-    validated_data = [Wine(**item).model_dump(exclude_none=exclude_none) for item in data]
-    return validated_data
+    # Parse and validate the whole batch of lines in one call to msgspec's C decoder (`strict=False`
+    # allows the same str -> int/float coercions as pydantic), then convert the structs to dicts
+    wines = decode_wines(b"\n".join(data))
+    if exclude_none:
+        # Pick the non-null fields off each struct directly, rather than copying every field into
+        # a dict with `asdict` and then filtering that
+        fields = WineStruct.__struct_fields__
+        return [{f: v for f in fields if (v := getattr(wine, f)) is not None} for wine in wines]
+    return [msgspec.structs.asdict(wine) for wine in wines]
 
 
 def get_meili_settings(filename: str) -> dict[str, Any]:
-    settings = dict(srsly.read_json(filename))
+    settings = msgspec.json.decode(Path(filename).read_bytes(), type=dict[str, Any])
     return settings
 
 
 def update_documents(filepath: Path, index: Index, primary_key: str, batch_size: int):
-    data = list(get_json_data(filepath))
+    data = get_json_data(filepath)
     if LIMIT > 0:
-        data = data[:LIMIT]
-    validated_data = validate(data)
-    index.update_documents_in_batches(
-        validated_data,
-        batch_size=batch_size,
-        primary_key=primary_key,
-    )
+        data = islice(data, LIMIT)
+    # Validate and send each batch as it's read from file, rather than loading the whole file first
+    for chunk in chunk_iterable(data, batch_size):
+        # Serialize the batch with msgspec, rather than the client's stdlib json encoder
+        index.update_documents_json(encode_json(validate(chunk)).decode(), primary_key=primary_key)
 
 
 def main(data_files: list[Path]) -> None:
     meili_settings = get_meili_settings(filename="settings/settings.json")
-    config = Settings()
+    config = get_settings()
     URI = f"http://{config.meili_url}:{config.meili_port}"
     MASTER_KEY = config.meili_master_key
     index_name = "wines"
@@ -118,11 +152,9 @@ if __name__ == "__main__":
     BENCHMARK_NUM = args["benchmark_num"]
 
     # Get a list of all files in the data directory
-    data_files = [f for f in DATA_DIR.glob("*.jsonl.gz") if f.is_file()]
+    data_files = get_data_files(DATA_DIR)
     # For benchmarking, we want to run on the same data multiple times (in the real world this would be many different files)
     benchmark_data_files = data_files * BENCHMARK_NUM
 
-    meili_settings = get_meili_settings(filename="settings/settings.json")
-
     # Run main function
     main(benchmark_data_files)
@@ -3,6 +3,7 @@ from contextlib import asynccontextmanager
 from functools import lru_cache
 
 from fastapi import FastAPI
+from fastapi.responses import ORJSONResponse
 from neo4j import AsyncGraphDatabase
 
 from api.config import Settings
@@ -22,12 +23,18 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     service = settings.neo4j_service
     URI = f"bolt://{service}:7687"
     AUTH = (settings.neo4j_user, settings.neo4j_password)
-    async with AsyncGraphDatabase.driver(URI, auth=AUTH) as driver:
-        async with driver.session(database="neo4j") as session:
-            app.session = session
-            print("Successfully connected to wine reviews Neo4j DB")
-            yield
-            print("Successfully closed wine reviews Neo4j connection")
+    # A single long-lived driver owns the connection pool, and routes open a session per request
+    async with AsyncGraphDatabase.driver(
+        URI,
+        auth=AUTH,
+        max_connection_pool_size=100,
+        connection_acquisition_timeout=30,
+        max_connection_lifetime=3600,
+    ) as driver:
+        app.driver = driver
+        print("Successfully connected to wine reviews Neo4j DB")
+        yield
+        print("Successfully closed wine reviews Neo4j connection")
 
 
 app = FastAPI(
@@ -37,6 +44,7 @@ app = FastAPI(
     ),
     version=get_settings().tag,
     lifespan=lifespan,
+    default_response_class=ORJSONResponse,
 )
 
 
@@ -1,21 +1,49 @@
+import time
+from typing import Any
+
+import orjson
 from api.schemas.rest import (
     FullTextSearch,
     MostWinesByVariety,
     TopWinesByCountry,
     TopWinesByProvince,
 )
-from fastapi import APIRouter, HTTPException, Query, Request
-from neo4j import AsyncManagedTransaction
+from fastapi import APIRouter, HTTPException, Query, Request, Response
+from fastapi.responses import ORJSONResponse
+from neo4j import AsyncManagedTransaction, AsyncSession
 
 router = APIRouter()
 
+# The top-rated wines for a country or province only change when the graph is rebuilt, so their
+# serialized responses are kept for a few minutes. Only names that match wines are cached, which
+# bounds the cache by the number of countries and provinces in the data
+CACHE_TTL_SECONDS = 300
+_response_cache: dict[tuple[str, str], tuple[float, bytes]] = {}
+
+
+def get_cached_response(key: tuple[str, str]) -> bytes | None:
+    if (entry := _response_cache.get(key)) is not None and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+
+def set_cached_response(key: tuple[str, str], content: bytes) -> None:
+    _response_cache[key] = (time.monotonic() + CACHE_TTL_SECONDS, content)
+
+
+def get_session(request: Request) -> AsyncSession:
+    # Sessions are cheap to open, and each one only borrows a connection from the driver's pool
+    # while its query runs, so concurrent requests don't queue up behind a single shared session
+    return request.app.driver.session(database="neo4j")
+
 
 # --- Routes ---
 
 
 @router.get(
     "/search",
-    response_model=list[FullTextSearch],
+    response_model=None,
+    responses={200: {"model": list[FullTextSearch]}},
     response_description="Search wines by title and description",
 )
 async def search_by_keywords(
@@ -24,20 +52,21 @@ async def search_by_keywords(
     max_price: float = Query(
         default=100.0, description="Specify the maximum price for the wine (e.g., 30)"
     ),
-) -> list[FullTextSearch] | None:
-    session = request.app.session
-    result = await session.execute_read(_search_by_keywords, terms, max_price)
+) -> ORJSONResponse:
+    async with get_session(request) as session:
+        result = await session.execute_read(_search_by_keywords, terms, max_price)
     if not result:
         raise HTTPException(
             status_code=404,
             detail=f"No wine with the provided terms '{terms}' found in database - please try again",
         )
-    return result
+    return ORJSONResponse(result)
 
 
 @router.get(
     "/top_by_country",
-    response_model=list[TopWinesByCountry],
+    response_model=None,
+    responses={200: {"model": list[TopWinesByCountry]}},
     response_description="Get top-rated wines by country",
 )
 async def top_by_country(
@@ -45,20 +74,25 @@ async def top_by_country(
     country: str = Query(
         description="Get top-rated wines by country name specified (must be exact name)"
     ),
-) -> list[TopWinesByCountry] | None:
-    session = request.app.session
-    result = await session.execute_read(_top_by_country, country)
-    if not result:
-        raise HTTPException(
-            status_code=404,
-            detail=f"No wine from the provided country '{country}' found in database - please enter exact country name",
-        )
-    return result
+) -> Response:
+    key = ("country", country.lower())
+    if (content := get_cached_response(key)) is None:
+        async with get_session(request) as session:
+            result = await session.execute_read(_top_by_country, country)
+        if not result:
+            raise HTTPException(
+                status_code=404,
+                detail=f"No wine from the provided country '{country}' found in database - please enter exact country name",
+            )
+        content = orjson.dumps(result)
+        set_cached_response(key, content)
+    return Response(content=content, media_type="application/json")
 
 
 @router.get(
     "/top_by_province",
-    response_model=list[TopWinesByProvince],
+    response_model=None,
+    responses={200: {"model": list[TopWinesByProvince]}},
     response_description="Get top-rated wines by province",
 )
 async def top_by_province(
@@ -66,20 +100,25 @@ async def top_by_province(
     province: str = Query(
         description="Get top-rated wines by province name specified (must be exact name)"
     ),
-) -> list[TopWinesByProvince] | None:
-    session = request.app.session
-    result = await session.execute_read(_top_by_province, province)
-    if not result:
-        raise HTTPException(
-            status_code=404,
-            detail=f"No wine from the provided province '{province}' found in database - please enter exact province name",
-        )
-    return result
+) -> Response:
+    key = ("province", province.lower())
+    if (content := get_cached_response(key)) is None:
+        async with get_session(request) as session:
+            result = await session.execute_read(_top_by_province, province)
+        if not result:
+            raise HTTPException(
+                status_code=404,
+                detail=f"No wine from the provided province '{province}' found in database - please enter exact province name",
+            )
+        content = orjson.dumps(result)
+        set_cached_response(key, content)
+    return Response(content=content, media_type="application/json")
 
 
 @router.get(
     "/most_by_variety",
-    response_model=list[MostWinesByVariety],
+    response_model=None,
+    responses={200: {"model": list[MostWinesByVariety]}},
     response_description="Get the countries with the most wines above a points-rating of a specified variety (blended or otherwise)",
 )
 async def most_by_variety(
@@ -91,15 +130,15 @@ async def most_by_variety(
         default=85,
         description="Specify the minimum points-rating for the wine (e.g., 85)",
     ),
-) -> list[MostWinesByVariety] | None:
-    session = request.app.session
-    result = await session.execute_read(_most_by_variety, variety, points)
+) -> ORJSONResponse:
+    async with get_session(request) as session:
+        result = await session.execute_read(_most_by_variety, variety, points)
     if not result:
         raise HTTPException(
             status_code=404,
             detail=f"No wine of the specified variety '{variety}' found in database - please try a different variety",
         )
-    return result
+    return ORJSONResponse(result)
 
 
 # --- Neo4j query funcs ---
@@ -109,7 +148,7 @@ async def _search_by_keywords(
     tx: AsyncManagedTransaction,
     terms: str,
     price: float,
-) -> list[FullTextSearch] | None:
+) -> list[dict[str, Any]] | None:
     query = """
         CALL db.index.fulltext.queryNodes("searchText", $terms) YIELD node AS wine, score
         WITH DISTINCT wine, score
@@ -127,19 +166,21 @@ async def _search_by_keywords(
         ORDER BY score DESC, points DESC LIMIT 5
     """
     response = await tx.run(query, terms=terms, price=price)
+    # The RETURN clause fixes the shape and types of each row, so the rows are serialized as they
+    # are, and the response models only document them in the OpenAPI schema
     result = await response.data()
     if result:
-        return [FullTextSearch(**r) for r in result]
+        return result
     return None
 
 
 async def _top_by_country(
     tx: AsyncManagedTransaction,
     country: str,
-) -> list[TopWinesByCountry] | None:
+) -> list[dict[str, Any]] | None:
     query = """
         MATCH (wine:Wine)-[:IS_FROM_COUNTRY]->(c:Country)
-        WHERE tolower(c.countryName) = tolower($country)
+        WHERE c.countryNameLower = toLower($country)
         RETURN
             wine.wineID AS wineID,
             wine.points AS points,
@@ -154,17 +195,17 @@ async def _top_by_country(
     response = await tx.run(query, country=country)
     result = await response.data()
     if result:
-        return [TopWinesByCountry(**r) for r in result]
+        return result
     return None
 
 
 async def _top_by_province(
     tx: AsyncManagedTransaction,
     province: str,
-) -> list[TopWinesByProvince] | None:
+) -> list[dict[str, Any]] | None:
     query = """
         MATCH (wine:Wine)-[:IS_FROM_PROVINCE]->(p:Province)-[:IS_LOCATED_IN]->(c:Country)
-        WHERE tolower(p.provinceName) = tolower($province)
+        WHERE p.provinceNameLower = toLower($province)
         RETURN
             wine.wineID AS wineID,
             wine.points AS points,
@@ -180,7 +221,7 @@ async def _top_by_province(
     response = await tx.run(query, province=province)
     result = await response.data()
     if result:
-        return [TopWinesByProvince(**r) for r in result]
+        return result
     return None
 
 
@@ -188,7 +229,7 @@ async def _most_by_variety(
     tx: AsyncManagedTransaction,
     variety: str,
     points: int,
-) -> list[MostWinesByVariety] | None:
+) -> list[dict[str, Any]] | None:
     query = """
         CALL db.index.fulltext.queryNodes("searchText", $variety) YIELD node AS wine, score
         WITH wine
@@ -202,5 +243,5 @@ async def _most_by_variety(
     response = await tx.run(query, variety=variety, points=points)
     result = await response.data()
     if result:
-        return [MostWinesByVariety(**r) for r in result]
+        return result
     return None
@@ -1,15 +1,19 @@
 import argparse
 import asyncio
+import io
 import os
 import sys
 import time
 from functools import lru_cache
+from itertools import islice
 from pathlib import Path
-from typing import Any, Iterator
+from typing import Any, Iterable, Iterator
 
-import srsly
+import orjson
 from dotenv import load_dotenv
+from isal import igzip
 from neo4j import AsyncGraphDatabase, AsyncManagedTransaction, AsyncSession
+from pydantic import TypeAdapter
 
 sys.path.insert(1, os.path.realpath(Path(__file__).resolve().parents[1]))
 from api.config import Settings
@@ -18,6 +22,8 @@ from schemas.wine import Wine
 # Custom types
 JsonBlob = dict[str, Any]
 
+WINE_LIST_ADAPTER = TypeAdapter(list[Wine])
+
 
 class FileNotFoundError(Exception):
     pass
@@ -33,33 +39,39 @@ def get_settings():
     return Settings()
 
 
-def chunk_iterable(item_list: list[JsonBlob], chunksize: int) -> Iterator[tuple[JsonBlob, ...]]:
+def chunk_iterable(items: Iterable[JsonBlob], chunksize: int) -> Iterator[tuple[JsonBlob, ...]]:
     """
     Break a large iterable into an iterable of smaller iterables of size `chunksize`
     """
-    for i in range(0, len(item_list), chunksize):
-        yield tuple(item_list[i : i + chunksize])
+    iterator = iter(items)
+    while chunk := tuple(islice(iterator, chunksize)):
+        yield chunk
+
+
+def read_gzip_jsonl(file_path: Path) -> Iterator[JsonBlob]:
+    """Stream records from a gzipped line-delimited json file (.jsonl.gz)"""
+    # Read the decompressed stream through a 1 MiB buffer and parse each line with orjson
+    with igzip.open(file_path, "rb") as fh:
+        for line in io.BufferedReader(fh, buffer_size=1 << 20):
+            if line := line.strip():
+                yield orjson.loads(line)
 
 
-def get_json_data(data_dir: Path, filename: str) -> list[JsonBlob]:
-    """Get all line-delimited json files (.jsonl) from a directory with a given prefix"""
+def get_json_data(data_dir: Path, filename: str) -> Iterator[JsonBlob]:
+    """Lazily read records from a gzipped line-delimited json file (.jsonl.gz)"""
     file_path = data_dir / filename
     if not file_path.is_file():
-        # File may not have been uncompressed yet so try to do that first
-        data = srsly.read_gzip_jsonl(file_path)
-        # This time if it isn't there it really doesn't exist
-        if not file_path.is_file():
-            raise FileNotFoundError(f"No valid .jsonl file found in `{data_dir}`")
-    else:
-        data = srsly.read_gzip_jsonl(file_path)
-    return data
+        raise FileNotFoundError(f"No valid .jsonl file found in `{data_dir}`")
+    return read_gzip_jsonl(file_path)
 
 
 def validate(
     data: list[JsonBlob],
     exclude_none: bool = False,
 ) -> list[JsonBlob]:
-    validated_data = [Wine(**item).model_dump(exclude_none=exclude_none) for item in data]
+    # Validate and dump the whole chunk in single calls into pydantic-core, rather than per record
+    wines = WINE_LIST_ADAPTER.validate_python(data)
+    validated_data = WINE_LIST_ADAPTER.dump_python(wines, exclude_none=exclude_none)
     return validated_data
 
 
@@ -79,6 +91,9 @@ async def create_indexes_and_constraints(session: AsyncSession) -> None:
         # indexes
         "CREATE INDEX provinceName IF NOT EXISTS FOR (p:Province) ON (p.provinceName) ",
         "CREATE INDEX tasterName IF NOT EXISTS FOR (p:Person) ON (p.tasterName) ",
+        # lowercased names, so that case-insensitive lookups by name are index seeks
+        "CREATE INDEX countryNameLower IF NOT EXISTS FOR (c:Country) ON (c.countryNameLower) ",
+        "CREATE INDEX provinceNameLower IF NOT EXISTS FOR (p:Province) ON (p.provinceNameLower) ",
         "CREATE FULLTEXT INDEX searchText IF NOT EXISTS FOR (w:Wine) ON EACH [w.title, w.description, w.variety] ",
     ]
     for query in queries:
@@ -107,10 +122,12 @@ async def build_query(tx: AsyncManagedTransaction, data: list[JsonBlob]) -> None
             MERGE (wine)-[:TASTED_BY]->(taster)
         WITH record, wine
             MERGE (country:Country {countryName: record.country})
+                SET country.countryNameLower = toLower(record.country)
             MERGE (wine)-[:IS_FROM_COUNTRY]->(country)
         WITH record, wine, country
         WHERE record.province IS NOT NULL
             MERGE (province:Province {provinceName: record.province})
+                SET province.provinceNameLower = toLower(record.province)
             MERGE (wine)-[:IS_FROM_PROVINCE]->(province)
         WITH record, wine, country, province
             WHERE record.province IS NOT NULL AND record.country IS NOT NULL
@@ -119,26 +136,22 @@ async def build_query(tx: AsyncManagedTransaction, data: list[JsonBlob]) -> None
     await tx.run(query, data=data)
 
 
-async def main(data: list[JsonBlob]) -> None:
+async def main(data: Iterable[JsonBlob]) -> None:
     async with AsyncGraphDatabase.driver(URI, auth=(NEO4J_USER, NEO4J_PASSWORD)) as driver:
         async with driver.session(database="neo4j") as session:
             # Create indexes and constraints
             await create_indexes_and_constraints(session)
-            # Validate
-            validation_start_time = time.time()
-            print("Validating data...")
-            validated_data = validate(data, exclude_none=True)
-            chunked_data = chunk_iterable(validated_data, CHUNKSIZE)
-            print(
-                f"Finished validating data in pydantic in {(time.time() - validation_start_time):.4f} sec"
-            )
-            # Bulk ingest
+            # Validate and ingest the data into Neo4j in chunks, as it's read from file
             ingestion_time = time.time()
-            # Ingest the data into Neo4j
-            for chunk in chunked_data:
+            chunks = chunk_iterable(data, CHUNKSIZE)
+            next_chunk = asyncio.create_task(asyncio.to_thread(next, chunks, None))
+            while chunk := await next_chunk:
+                # Decompress and parse the next chunk in a thread while this one is written
+                next_chunk = asyncio.create_task(asyncio.to_thread(next, chunks, None))
                 ids = [item["id"] for item in chunk]
                 try:
-                    await session.execute_write(build_query, chunk)
+                    validated_data = validate(chunk, exclude_none=True)
+                    await session.execute_write(build_query, validated_data)
                     print(f"Processed ids in range {min(ids)}-{max(ids)}")
                 except Exception as e:
                     print(f"{e}: Failed to ingest IDs in range {min(ids)}-{max(ids)}")
@@ -165,9 +178,9 @@ if __name__ == "__main__":
     NEO4J_USER = settings.neo4j_user
     NEO4J_PASSWORD = settings.neo4j_password
 
-    data = list(get_json_data(DATA_DIR, FILENAME))
+    data = get_json_data(DATA_DIR, FILENAME)
     if LIMIT > 0:
-        data = data[:LIMIT]
+        data = islice(data, LIMIT)
 
     # Run main async event loop using uvloop for slightly better performance
     # Neo4j async python driver uses uvloop under the hood, which is why it makes sense
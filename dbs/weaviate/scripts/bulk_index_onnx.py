@@ -1,17 +1,20 @@
 import argparse
-import json
+import io
 import os
 import sys
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, as_completed, wait
 from functools import lru_cache
+from itertools import islice
 from pathlib import Path
-from typing import Any, Iterator
+from typing import Any, Iterable, Iterator
 
-import srsly
+import orjson
 import weaviate
 from dotenv import load_dotenv
+from isal import igzip
 from optimum.onnxruntime import ORTModelForCustomTasks
 from optimum.pipelines import pipeline
+from pydantic import TypeAdapter
 from tqdm import tqdm
 from transformers import AutoTokenizer
 from weaviate.client import Client
@@ -24,6 +27,8 @@ load_dotenv()
 # Custom types
 JsonBlob = dict[str, Any]
 
+WINE_LIST_ADAPTER = TypeAdapter(list[Wine])
+
 
 class FileNotFoundError(Exception):
     pass
@@ -35,33 +40,58 @@ def get_settings():
     return Settings()
 
 
-def chunk_iterable(item_list: list[JsonBlob], chunksize: int) -> Iterator[tuple[JsonBlob, ...]]:
+def chunk_iterable(items: Iterable[bytes], chunksize: int) -> Iterator[tuple[bytes, ...]]:
     """
     Break a large iterable into an iterable of smaller iterables of size `chunksize`
     """
-    for i in range(0, len(item_list), chunksize):
-        yield tuple(item_list[i : i + chunksize])
+    iterator = iter(items)
+    while chunk := tuple(islice(iterator, chunksize)):
+        yield chunk
+
+
+def read_gzip_jsonl(file_path: Path) -> Iterator[bytes]:
+    """Stream raw lines of json from a gzipped line-delimited json file (.jsonl.gz)"""
+    # Read the decompressed stream through a 1 MiB buffer, leaving the lines to be parsed by workers
+    with igzip.open(file_path, "rb") as fh:
+        for line in io.BufferedReader(fh, buffer_size=1 << 20):
+            if line := line.strip():
+                yield line
+
 
+def parse_jsonl_chunk(data: bytes) -> list[JsonBlob]:
+    """Parse a chunk of newline-separated json lines with a single orjson call"""
+    return orjson.loads(b"[" + data.replace(b"\n", b",") + b"]")
 
-def get_json_data(data_dir: Path, filename: str) -> list[JsonBlob]:
-    """Get all line-delimited json files (.jsonl) from a directory with a given prefix"""
+
+def get_json_data(data_dir: Path, filename: str) -> Iterator[bytes]:
+    """Lazily read lines from a gzipped line-delimited json file (.jsonl.gz)"""
     file_path = data_dir / filename
     if not file_path.is_file():
-        # File may not have been uncompressed yet so try to do that first
-        data = srsly.read_gzip_jsonl(file_path)
-        # This time if it isn't there it really doesn't exist
-        if not file_path.is_file():
-            raise FileNotFoundError(f"No valid .jsonl file found in `{data_dir}`")
-    else:
-        data = srsly.read_gzip_jsonl(file_path)
-    return data
+        raise FileNotFoundError(f"No valid .jsonl file found in `{data_dir}`")
+    return read_gzip_jsonl(file_path)
+
+
+def add_to_vectorize(data: Iterable[JsonBlob]) -> None:
+    "Add a lowercased field to_vectorize to each item, used to create its sentence embedding"
+    for item in data:
+        fields = (
+            item.get("variety"),
+            item.get("country"),
+            item.get("province"),
+            item.get("title"),
+            item.get("description"),
+        )
+        item["to_vectorize"] = " ".join(filter(None, fields)).strip().lower()
 
 
 def validate(
     data: list[JsonBlob],
     exclude_none: bool = False,
 ) -> list[JsonBlob]:
-    validated_data = [Wine(**item).model_dump(exclude_none=exclude_none) for item in data]
+    add_to_vectorize(data)
+    # Validate and dump the whole chunk in single calls into pydantic-core, rather than per record
+    wines = WINE_LIST_ADAPTER.validate_python(data)
+    validated_data = WINE_LIST_ADAPTER.dump_python(wines, exclude_none=exclude_none)
     return validated_data
 
 
@@ -78,8 +108,7 @@ def get_embedding_pipeline(onnx_path, model_filename: str) -> pipeline:
 
 def create_or_update_schema(client: Client) -> None:
     # Create a schema with no vectorizer (we will be adding our own vectors)
-    with open("settings/schema.json", "r") as f:
-        schema = json.load(f)
+    schema = orjson.loads(Path("settings/schema.json").read_bytes())
     class_names = [class_["class"] for class_ in schema["classes"]]
     assert class_names, "No classes found in schema, please check schema definition and try again"
     if not client.schema.get()["classes"]:
@@ -91,13 +120,13 @@ def create_or_update_schema(client: Client) -> None:
         client.schema.create(schema)
 
 
-def add_vectors_to_index(data_chunk: tuple[JsonBlob, ...]) -> None:
+def add_vectors_to_index(data_chunk: bytes) -> None:
     settings = get_settings()
     CLASS_NAME = "Wine"
     HOST = settings.weaviate_host
     PORT = settings.weaviate_port
     client = weaviate.Client(f"http://{HOST}:{PORT}")
-    data = validate(data_chunk, exclude_none=True)
+    data = validate(parse_jsonl_chunk(data_chunk), exclude_none=True)
 
     # Preload optimized, quantized ONNX sentence transformers model
     # NOTE: This requires that the script ../onnx_model/onnx_optimizer.py has been run beforehand
@@ -107,7 +136,7 @@ def add_vectors_to_index(data_chunk: tuple[JsonBlob, ...]) -> None:
     # Rename "id" (Weaviate reserves the "id" key for its own uuid assignment, so we can't use it)
     data = [{"wineID": id, **fields} for id, fields in zip(ids, data)]
     to_vectorize = [text.pop("to_vectorize") for text in data]
-    sentence_embeddings = [pipeline(text.lower(), truncate=True)[0][0] for text in to_vectorize]
+    sentence_embeddings = [pipeline(text, truncate=True)[0][0] for text in to_vectorize]
     print(f"Finished vectorizing data in the ID range {min(ids)}-{max(ids)}")
     try:
         # Use a context manager to manage batch flushing
@@ -125,7 +154,7 @@ def add_vectors_to_index(data_chunk: tuple[JsonBlob, ...]) -> None:
         print(f"{e}: Failed to index items in the ID range {min(ids)}-{max(ids)} to db")
 
 
-def main(chunked_data: Iterator[tuple[JsonBlob, ...]]) -> None:
+def main(data: Iterable[bytes]) -> None:
     settings = get_settings()
     CLASS_NAME = "Wine"
     HOST = settings.weaviate_host
@@ -136,9 +165,17 @@ def main(chunked_data: Iterator[tuple[JsonBlob, ...]]) -> None:
 
     print("Processing chunks")
     with ProcessPoolExecutor(max_workers=WORKERS) as executor:
-        chunked_data = chunk_iterable(data, CHUNKSIZE)
-        for _ in executor.map(add_vectors_to_index, chunked_data):
-            pass
+        # Submit chunks as they're read from file, but keep no more than a couple of chunks per worker
+        # in flight, so that reading the file is throttled by how fast the workers index the data
+        pending: set[Future] = set()
+        for chunk in chunk_iterable(data, CHUNKSIZE):
+            if len(pending) >= 2 * WORKERS:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            pending.add(executor.submit(add_vectors_to_index, b"\n".join(chunk)))
+        for future in as_completed(pending):
+            future.result()
 
 
 if __name__ == "__main__":
@@ -158,9 +195,9 @@ if __name__ == "__main__":
     WORKERS = args["workers"]
     ONNX_PATH = Path(__file__).parents[1] / "onnx_model" / "onnx"
 
-    data = list(get_json_data(DATA_DIR, FILENAME))
+    data = get_json_data(DATA_DIR, FILENAME)
+    if LIMIT > 0:
+        data = islice(data, LIMIT)
 
-    if data:
-        data = data[:LIMIT] if LIMIT > 0 else data
-        main(data)
-        print("Finished execution!")
+    main(data)
+    print("Finished execution!")
@@ -1,14 +1,18 @@
 import argparse
+import io
 import os
 import sys
-from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, as_completed, wait
 from functools import lru_cache
+from itertools import islice
 from pathlib import Path
-from typing import Any, Iterator
+from typing import Any, Iterable, Iterator
 
-import srsly
+import orjson
 import weaviate
 from dotenv import load_dotenv
+from isal import igzip
+from pydantic import TypeAdapter
 from sentence_transformers import SentenceTransformer
 from weaviate.client import Client
 
@@ -20,6 +24,10 @@ load_dotenv()
 # Custom types
 JsonBlob = dict[str, Any]
 
+WINE_LIST_ADAPTER = TypeAdapter(list[Wine])
+# Sentence embedding model, loaded in each worker process by `init_worker`
+MODEL: SentenceTransformer | None = None
+
 
 class FileNotFoundError(Exception):
     pass
@@ -31,39 +39,72 @@ def get_settings():
     return Settings()
 
 
-def chunk_iterable(item_list: list[JsonBlob], chunksize: int) -> Iterator[tuple[JsonBlob, ...]]:
+def chunk_iterable(items: Iterable[bytes], chunksize: int) -> Iterator[tuple[bytes, ...]]:
     """
     Break a large iterable into an iterable of smaller iterables of size `chunksize`
     """
-    for i in range(0, len(item_list), chunksize):
-        yield tuple(item_list[i : i + chunksize])
+    iterator = iter(items)
+    while chunk := tuple(islice(iterator, chunksize)):
+        yield chunk
+
+
+def read_gzip_jsonl(file_path: Path) -> Iterator[bytes]:
+    """Stream raw lines of json from a gzipped line-delimited json file (.jsonl.gz)"""
+    # Read the decompressed stream through a 1 MiB buffer, leaving the lines to be parsed by workers
+    with igzip.open(file_path, "rb") as fh:
+        for line in io.BufferedReader(fh, buffer_size=1 << 20):
+            if line := line.strip():
+                yield line
+
 
+def parse_jsonl_chunk(data: bytes) -> list[JsonBlob]:
+    """Parse a chunk of newline-separated json lines with a single orjson call"""
+    return orjson.loads(b"[" + data.replace(b"\n", b",") + b"]")
 
-def get_json_data(data_dir: Path, filename: str) -> list[JsonBlob]:
-    """Get all line-delimited json files (.jsonl) from a directory with a given prefix"""
+
+def get_json_data(data_dir: Path, filename: str) -> Iterator[bytes]:
+    """Lazily read lines from a gzipped line-delimited json file (.jsonl.gz)"""
     file_path = data_dir / filename
     if not file_path.is_file():
-        # File may not have been uncompressed yet so try to do that first
-        data = srsly.read_gzip_jsonl(file_path)
-        # This time if it isn't there it really doesn't exist
-        if not file_path.is_file():
-            raise FileNotFoundError(f"No valid .jsonl file found in `{data_dir}`")
-    else:
-        data = srsly.read_gzip_jsonl(file_path)
-    return data
+        raise FileNotFoundError(f"No valid .jsonl file found in `{data_dir}`")
+    return read_gzip_jsonl(file_path)
+
+
+def add_to_vectorize(data: Iterable[JsonBlob]) -> None:
+    "Add a lowercased field to_vectorize to each item, used to create its sentence embedding"
+    for item in data:
+        fields = (
+            item.get("variety"),
+            item.get("country"),
+            item.get("province"),
+            item.get("title"),
+            item.get("description"),
+        )
+        item["to_vectorize"] = " ".join(filter(None, fields)).strip().lower()
 
 
 def validate(
     data: list[JsonBlob],
     exclude_none: bool = False,
 ) -> list[JsonBlob]:
-    validated_data = [Wine(**item).model_dump(exclude_none=exclude_none) for item in data]
+    add_to_vectorize(data)
+    # Validate and dump the whole chunk in single calls into pydantic-core, rather than per record
+    wines = WINE_LIST_ADAPTER.validate_python(data)
+    validated_data = WINE_LIST_ADAPTER.dump_python(wines, exclude_none=exclude_none)
     return validated_data
 
 
+def init_worker() -> None:
+    "Load the sentence transformer model once per worker process, rather than once per chunk"
+    global MODEL
+    model_id = get_settings().embedding_model_checkpoint
+    assert model_id, "Invalid embedding model checkpoint specified in .env file"
+    MODEL = SentenceTransformer(model_id)
+
+
 def create_or_update_schema(client: Client) -> None:
     # Create a schema with no vectorizer (we will be adding our own vectors)
-    schema = dict(srsly.read_json("settings/schema.json"))
+    schema = orjson.loads(Path("settings/schema.json").read_bytes())
     assert schema, "No schema found, please check schema definition and try again"
     class_names = [class_["class"] for class_ in schema["classes"]]
     assert class_names, "No classes found in schema, please check schema definition and try again"
@@ -76,23 +117,19 @@ def create_or_update_schema(client: Client) -> None:
         client.schema.create(schema)
 
 
-def add_vectors_to_index(data_chunk: tuple[JsonBlob, ...]) -> None:
+def add_vectors_to_index(data_chunk: bytes) -> None:
     settings = get_settings()
     CLASS_NAME = "Wine"
     HOST = settings.weaviate_host
     PORT = settings.weaviate_port
     client = weaviate.Client(f"http://{HOST}:{PORT}")
-    data = validate(data_chunk, exclude_none=True)
-
-    # Load a sentence transformer model for semantic similarity from a specified checkpoint
-    model_id = get_settings().embedding_model_checkpoint
-    MODEL = SentenceTransformer(model_id)
+    data = validate(parse_jsonl_chunk(data_chunk), exclude_none=True)
 
     ids = [item.pop("id") for item in data]
     # Rename "id" (Weaviate reserves the "id" key for its own uuid assignment, so we can't use it)
     data = [{"wineID": id, **fields} for id, fields in zip(ids, data)]
     to_vectorize = [text.pop("to_vectorize") for text in data]
-    sentence_embeddings = [MODEL.encode(text.lower(), batch_size=64) for text in to_vectorize]
+    sentence_embeddings = MODEL.encode(to_vectorize, batch_size=64)
     print(f"Finished vectorizing data in the ID range {min(ids)}-{max(ids)}")
     try:
         # Use a context manager to manage batch flushing
@@ -109,7 +146,7 @@ def add_vectors_to_index(data_chunk: tuple[JsonBlob, ...]) -> None:
         print(f"{e}: Failed to index items in the ID range {min(ids)}-{max(ids)} to db")
 
 
-def main(chunked_data: Iterator[tuple[JsonBlob, ...]]) -> None:
+def main(data: Iterable[bytes]) -> None:
     settings = get_settings()
     HOST = settings.weaviate_host
     PORT = settings.weaviate_port
@@ -118,10 +155,19 @@ def main(chunked_data: Iterator[tuple[JsonBlob, ...]]) -> None:
     create_or_update_schema(client)
 
     print("Processing chunks")
-    with ProcessPoolExecutor(max_workers=4) as executor:
-        chunked_data = chunk_iterable(data, CHUNKSIZE)
-        for _ in executor.map(add_vectors_to_index, chunked_data):
-            pass
+    with ProcessPoolExecutor(max_workers=WORKERS, initializer=init_worker) as executor:
+        # Submit chunks as they're read from file, but keep no more than a couple of chunks per worker
+        # in flight, so that reading the file is throttled by how fast the workers index the data
+        pending: set[Future] = set()
+        for chunk in chunk_iterable(data, CHUNKSIZE):
+            if len(pending) >= 2 * WORKERS:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+            # Workers parse the lines themselves, so only one bytes object is pickled per chunk
+            pending.add(executor.submit(add_vectors_to_index, b"\n".join(chunk)))
+        for future in as_completed(pending):
+            future.result()
 
 
 if __name__ == "__main__":
@@ -140,9 +186,9 @@ if __name__ == "__main__":
     CHUNKSIZE = args["chunksize"]
     WORKERS = args["workers"]
 
-    data = list(get_json_data(DATA_DIR, FILENAME))
+    data = get_json_data(DATA_DIR, FILENAME)
+    if LIMIT > 0:
+        data = islice(data, LIMIT)
 
-    if data:
-        data = data[:LIMIT] if LIMIT > 0 else data
-        main(data)
-        print("Finished execution!")
+    main(data)
+    print("Finished execution!")